@@ -0,0 +1,78 @@
+import asyncio
+import codecs
+import os
+
+from typing import Callable, Final
+
+from keyboard import Keyboard, State
+from nethack import NetHack
+from tasks import Executor
+from term import Term, Subscription, SCREEN_LOG_FIFO
+
+# How often to look for the game again while nobody writes the FIFO
+REOPEN_INTERVAL: Final[float] = 0.2
+
+class Core:
+    # One event loop instead of the parser, follow and main threads.
+    # Actions are the same synchronous code the threaded core runs, on the Executor's task
+    # thread, so they pause and abort alike. The input backend keeps a thread of its own too.
+    def __init__(self, term: Term, kb: Keyboard, nh: NetHack, executor: Executor,
+                 handle: Callable[[str, State], bool]) -> None:
+        self.term = term
+        self.kb = kb
+        self.nh = nh
+        self.executor = executor
+        # Shared with the threaded main loop, False quits
+        self.handle = handle
+        self.loop: asyncio.AbstractEventLoop
+        self.keys: asyncio.Queue[tuple[str, State]]
+        self.changes: Subscription
+
+    async def read_term(self) -> None:
+        decoder = codecs.getincrementaldecoder('utf8')()
+        while True:
+            # Non-blocking: a FIFO without a writer opens right away and reads as EOF,
+            # instead of parking a thread in open() that would keep asyncio.run from exiting
+            fd = os.open(SCREEN_LOG_FIFO, os.O_RDONLY | os.O_NONBLOCK)
+            reader = asyncio.StreamReader()
+            transport, _ = await self.loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+            try:
+                while data := await reader.read(4096):
+                    if not self.term.fitted:
+                        self.term.fit()
+                    self.term.apply_geometry()
+                    self.term.feed(decoder.decode(data))
+            finally:
+                transport.close()
+            await asyncio.sleep(REOPEN_INTERVAL)
+
+    def follow(self) -> None:
+        # A frame listener: the bus publishes before listeners run, this frame's changes are queued
+        if changed := self.changes.drain():
+            self.nh.track(changed)
+
+    def on_key(self, key: str, state: State) -> None:
+        # Called on the input backend's thread
+        self.loop.call_soon_threadsafe(self.keys.put_nowait, (key, state))
+
+    async def main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.keys = asyncio.Queue()
+        self.changes = self.nh.subscribe_map()
+        self.term.listeners.append(self.follow)
+        self.kb.add_callback(self.on_key)
+
+        tasks = [
+            asyncio.create_task(self.read_term()),
+            asyncio.create_task(asyncio.to_thread(self.kb.start)),
+        ]
+
+        while self.handle(*await self.keys.get()):
+            pass
+
+        # The task may still need frames to restore its options, keep parsing meanwhile
+        await asyncio.to_thread(self.executor.join, 1.0)
+        self.kb.stop()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,353 @@
+import argparse
+import gc
+import json
+import logging
+import random
+import re
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Final, TypeAlias
+
+import sokoban
+from keyboard import Keyboard, NullBackend
+from knowledge import Knowledge
+from nethack import NetHack
+from point import Point
+from term import Term, ESC, CSI, SCREEN_LOG_TXT
+
+BENCH_BASELINE: Final[Path] = Path(__file__).parents[1] / 'res' / 'bench_baseline.json'
+BENCH_JSON: Final[Path] = Path(__file__).parents[1] / 'tmp' / 'bench.json'
+
+# Shorter samples swing by more than any threshold worth setting
+MIN_BUDGET: Final[float] = 0.5
+# How many times the measured spread a ratio may exceed the threshold by before it counts
+SPREAD_FACTOR: Final[float] = 1.0
+
+# A benchmark builds its fixtures once and returns the operation to time
+Setup: TypeAlias = Callable[[], Callable[[], object]]
+
+LEVELS: Final[list[Path]] = sorted(sokoban.SOLUTIONS_DIR.glob('*.txt'))
+
+def render_level(sl_map: list[list[str]], name: str) -> str:
+    # Draws a solution map the way the game does, at NetHack.START
+    out = [CSI + 'H' + CSI + '2J' + CSI + '?25l']
+    out.append(CSI + '1;1H' + f'Welcome to NetHack! You are on level {name}.' + CSI + 'K')
+    for y, row in enumerate(sl_map):
+        out.append(f'{CSI}{y + NetHack.START.y + 1};{NetHack.START.x + 1}H')
+        for c in row:
+            if c == '#':
+                out.append(ESC + '(0x' + ESC + '(B')
+            elif c == '.':
+                out.append(ESC + '(0~' + ESC + '(B')
+            elif c.isupper():
+                out.append('0')
+            else:
+                out.append(c)
+    out.append(f'{CSI}{NetHack.START.y + NetHack.HEIGHT + 1};1H'
+               'Agent the Stripling   St:16 Dx:14 Co:18 In:7 Wi:9 Ch:8 Lawful\r\n')
+    out.append('Dlvl:6 $:55 HP:16(16) Pw:2(2) AC:6 Xp:1/0 T:1234')
+    return ''.join(out)
+
+def render_stream(moves: int = 30, seed: int = 1) -> str:
+    # All levels, each followed by frames of the player hopping around
+    rng = random.Random(seed)
+    out = [CSI + '2J']
+    for path in LEVELS:
+        out.append(render_level(sokoban.read_solution(path)[0].sl_map, path.name))
+        for _ in range(moves):
+            y, x = rng.randint(7, 18), rng.randint(3, 30)
+            out.append(f'{CSI}{y};{x}H@{CSI}D{CSI}?25h{CSI}?25l')
+        out.append(CSI + '?25h')
+    return ''.join(out)
+
+def render_text(lines: int = 300) -> str:
+    # Messages and status lines, long printable runs between a few sequences
+    out = [CSI + '2J']
+    for i in range(lines):
+        out.append(f'{CSI}{i % 24 + 1};1H'
+                   'You see here a blessed +2 pair of speed boots (being worn). '
+                   f'The kitten picks up {i} gems.{CSI}K')
+    return ''.join(out)
+
+def make_nethack(stream: str = '') -> NetHack:
+    term = Term(logging.getLogger('bench'), fifo=False)
+    nh = NetHack(term, Keyboard(NullBackend()), Knowledge('bench', NetHack.WIDTH, NetHack.HEIGHT,
+                                                       Path(':memory:')))
+    term.feed(stream)
+    return nh
+
+def level_screen(path: Path) -> tuple[NetHack, list[sokoban.Solution]]:
+    solution = sokoban.read_solution(path)
+    nh = make_nethack(render_level(solution[0].sl_map, path.name))
+    for y, row in enumerate(solution[0].sl_map):
+        for x, cell in enumerate(row):
+            if cell == '@':
+                nh.pos = Point(x, y) + Point(1, 1)
+    return nh, solution
+
+def bench_term_parse() -> Callable[[], object]:
+    stream = render_stream()
+
+    def run() -> None:
+        Term(logging.getLogger('bench'), fifo=False).feed(stream)
+    return run
+
+def bench_term_text() -> Callable[[], object]:
+    stream = render_text()
+
+    def run() -> None:
+        Term(logging.getLogger('bench'), fifo=False).feed(stream)
+    return run
+
+def bench_term_recorded() -> Callable[[], object]:
+    with open(SCREEN_LOG_TXT, 'r', encoding='utf8', newline='') as fp:
+        stream = fp.read()
+
+    def run() -> None:
+        Term(logging.getLogger('bench'), fifo=False).feed(stream)
+    return run
+
+def bench_term_scroll() -> Callable[[], object]:
+    term = make_nethack(render_stream(moves=0)).term
+
+    def run() -> None:
+        for _ in range(24):
+            term.scroll(1)
+        for _ in range(24):
+            term.scroll(-1)
+    return run
+
+def bench_term_clear() -> Callable[[], object]:
+    term = make_nethack(render_stream(moves=0)).term
+
+    def run() -> None:
+        term.cursor = Point(1, 12)
+        term.handle_csi(CSI + 'J')
+        term.handle_csi(CSI + '1J')
+        term.handle_csi(CSI + '2K')
+    return run
+
+def bench_classify() -> Callable[[], object]:
+    # is_covered only reads what the classifier keeps up to date, time the update itself
+    nh, _ = level_screen(LEVELS[0])
+    screen = nh.screen
+    rows = [(y, nh.term.line(y)) for y in range(nh.term.maxy + 1)]
+
+    def run() -> None:
+        for y, text in rows:
+            screen.classify_row(y, text)
+        screen.classify()
+    return run
+
+def bench_find_enemy() -> Callable[[], object]:
+    # has_enemies is find_enemy after a 1 ms yield, the yield is not worth timing
+    nh, _ = level_screen(LEVELS[0])
+    return nh.find_enemy
+
+def bench_is_wall() -> Callable[[], object]:
+    nh, _ = level_screen(LEVELS[0])
+    points = [Point(x, y) for y in range(nh.HEIGHT) for x in range(nh.WIDTH)]
+
+    def run() -> None:
+        for p in points:
+            nh.is_wall(p)
+    return run
+
+def bench_read_solution() -> Callable[[], object]:
+    def run() -> None:
+        for path in LEVELS:
+            sokoban.read_solution(path)
+    return run
+
+def bench_match_map() -> Callable[[], object]:
+    screens = [level_screen(path) for path in LEVELS]
+
+    def run() -> None:
+        for nh, solution in screens:
+            if sokoban.match_map(solution, nh) is None:
+                raise ValueError('Fixture screen does not match its solution')
+    return run
+
+def bench_cursor_keys() -> Callable[[], object]:
+    rng = random.Random(2)
+    pairs = [(Point(rng.randrange(80), rng.randrange(21)),
+              Point(rng.randrange(80), rng.randrange(21))) for _ in range(200)]
+    nh = make_nethack()
+
+    def run() -> None:
+        for src, dst in pairs:
+            nh.cursor_keys(src, dst)
+    return run
+
+def bench_compile_solution() -> Callable[[], object]:
+    solutions = []
+    for path in LEVELS:
+        solution = sokoban.read_solution(path)
+        for y, row in enumerate(solution[0].sl_map):
+            for x, cell in enumerate(row):
+                if cell == '@':
+                    solutions.append((solution, Point(x, y)))
+
+    def run() -> None:
+        for solution, player in solutions:
+            sokoban.compile_solution(solution, player)
+    return run
+
+def bench_cold_import() -> Callable[[], object]:
+    # A fresh interpreter importing what main.py imports before it starts
+    command = [sys.executable, '-c',
+               'import sokoban, term, nethack, stats, profiler, tasks, dungeon, keyboard']
+
+    def run() -> None:
+        subprocess.run(command, check=True, cwd=Path(__file__).parent)
+    return run
+
+BENCHMARKS: Final[dict[str, Setup]] = {
+    'term_parse': bench_term_parse,
+    'term_text': bench_term_text,
+    'term_recorded': bench_term_recorded,
+    'term_scroll': bench_term_scroll,
+    'term_clear': bench_term_clear,
+    'classify': bench_classify,
+    'find_enemy': bench_find_enemy,
+    'is_wall': bench_is_wall,
+    'read_solution': bench_read_solution,
+    'match_map': bench_match_map,
+    'cursor_keys': bench_cursor_keys,
+    'compile_solution': bench_compile_solution,
+    'cold_import': bench_cold_import,
+}
+
+def calibration() -> None:
+    # Fixed interpreter work: timings are stored relative to it, so a baseline
+    # taken on one machine still means something on another
+    table: dict[int, str] = {}
+    for i in range(2000):
+        table[i % 97] = str(i * i)
+    ''.join(table.values()).split('1')
+
+def timed(op: Callable[[], object], number: int) -> float:
+    # Like timeit: collector pauses would land on whichever op allocates last
+    gc.collect()
+    gc.disable()
+    try:
+        start = perf_counter()
+        for _ in range(number):
+            op()
+        return (perf_counter() - start) / number
+    finally:
+        gc.enable()
+
+def loops(op: Callable[[], object], seconds: float) -> int:
+    # From a warm call: the first one pays for cold caches and lazy imports
+    op()
+    return max(1, int(seconds / max(timed(op, 1), 1e-7)))
+
+def measure(op: Callable[[], object], budget: float, repeat: int) -> dict[str, float]:
+    # Every repeat is bracketed by the calibration loop, so it is measured in units of
+    # the machine's speed at that moment: on a shared box that drifts within a second
+    number = loops(op, budget / repeat)
+    units = loops(calibration, budget / repeat / 4)
+
+    times, ratios = [], []
+    for _ in range(repeat):
+        before = timed(calibration, units)
+        times.append(timed(op, number))
+        after = timed(calibration, units)
+        ratios.append(times[-1] / ((before + after) / 2))
+    relative = statistics.median(ratios)
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'relative': relative,
+        # Half the range of the repeats, the noise of this sample
+        'spread': (max(ratios) - min(ratios)) / 2 / relative,
+        'number': number,
+        'repeat': repeat,
+    }
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]],
+            threshold: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if 'relative' not in baseline[name]:
+            continue # absolute timings from before calibration, meaningless elsewhere
+        # Both in units of the calibration loop measured next to them
+        ratio = result['relative'] / baseline[name]['relative']
+        result['ratio'] = ratio
+        # Noisy samples on either side widen what counts as a slowdown
+        noise = result['spread'] + baseline[name].get('spread', 0.0)
+        if ratio > 1 + threshold + SPREAD_FACTOR * noise:
+            regressions.append(name)
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Micro-benchmarks, compared against a baseline')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks matching this regex')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help=f'seconds per benchmark, at least {MIN_BUDGET}')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the baseline, '
+                             'widened by the measured spread')
+    parser.add_argument('--baseline', type=Path, default=BENCH_BASELINE)
+    parser.add_argument('--json', type=Path, default=BENCH_JSON, help='where to write results')
+    parser.add_argument('--update', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args()
+
+    logging.getLogger('bench').addHandler(logging.NullHandler())
+    logging.getLogger('bench').propagate = False
+
+    budget = args.budget
+    if budget < MIN_BUDGET:
+        print(f'Budget raised to {MIN_BUDGET}s, shorter samples are too noisy to compare')
+        budget = MIN_BUDGET
+
+    results: dict[str, dict[str, float]] = {}
+    for name, setup in BENCHMARKS.items():
+        if not re.search(args.filter, name):
+            continue
+        if name == 'term_recorded' and not SCREEN_LOG_TXT.exists():
+            print(f'{name:<20} skipped, no {SCREEN_LOG_TXT}')
+            continue
+        results[name] = measure(setup(), budget, args.repeat)
+
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline, 'r', encoding='utf8') as fp:
+            baseline = json.load(fp)
+    regressions = compare(results, baseline, args.threshold)
+
+    print(f'{"name":<20}{"median":>12}{"min":>12}{"vs base":>10}')
+    for name, r in results.items():
+        ratio = f'{r["ratio"]:>9.2f}x' if 'ratio' in r else f'{"-":>10}'
+        flag = '  REGRESSION' if name in regressions else ''
+        print(f'{name:<20}{r["median"] * 1e6:>10.1f}us{r["min"] * 1e6:>10.1f}us{ratio}{flag}')
+
+    args.json.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.json, 'w', encoding='utf8') as fp:
+        json.dump(results, fp, indent=2)
+
+    if args.update:
+        with open(args.baseline, 'w', encoding='utf8') as fp:
+            fresh = {name: {k: v for k, v in r.items() if k != 'ratio'}
+                     for name, r in results.items()}
+            json.dump({**baseline, **fresh}, fp, indent=2)
+        print(f'Baseline updated: {args.baseline}')
+        return 0
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) over {args.threshold:.0%}: '
+              f'{", ".join(regressions)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import heapq
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Final, TypeAlias
+
+import tasks
+from knowledge import Key, MAIN
+from point import Point
+from term import DEC_CHARSET
+
+if TYPE_CHECKING:
+    from nethack import NetHack
+
+SCHEMA: Final[str] = '''
+CREATE TABLE IF NOT EXISTS dungeon_stairs (
+    game TEXT, branch TEXT, dlvl INTEGER, x INTEGER, y INTEGER, char TEXT,
+    PRIMARY KEY (game, branch, dlvl, x, y)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dungeon_links (
+    game TEXT, branch TEXT, dlvl INTEGER, x INTEGER, y INTEGER,
+    to_branch TEXT, to_dlvl INTEGER, to_x INTEGER, to_y INTEGER,
+    PRIMARY KEY (game, branch, dlvl, x, y)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dungeon_marks (
+    game TEXT, name TEXT, branch TEXT, dlvl INTEGER, x INTEGER, y INTEGER,
+    PRIMARY KEY (game, name)
+) WITHOUT ROWID;
+'''
+
+STAIRS: Final[dict[str, int]] = {'<': -1, '>': 1}
+OPPOSITE: Final[dict[str, str]] = {'<': '>', '>': '<'}
+WALLS: Final[frozenset[str]] = frozenset(DEC_CHARSET[code] for code in range(0x6a, 0x79))
+STEPS: Final[list[Point]] = [Point(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+# A level and where on it we stand, None for not yet known
+Node: TypeAlias = tuple[Key, Point | None]
+
+@dataclass(frozen=True)
+class Link:
+    to: Key
+    arrival: Point
+
+@dataclass(frozen=True)
+class Hop:
+    level: Key
+    stair: Point
+    char: str
+
+class Dungeon:
+    # pylint: disable=too-many-instance-attributes
+    # Stairs seen on every level and where taking them led, kept next to the map memory
+    # Walking cost assumed from a stair we never arrived by
+    UNKNOWN_COST: Final[int] = 40
+
+    def __init__(self, nh: 'NetHack',
+                 detectors: dict[str, Callable[['NetHack'], bool]] | None = None) -> None:
+        self.nh = nh
+        self.knowledge = nh.knowledge
+        self.game = nh.knowledge.game
+        self.detectors = detectors or {}
+        self.stairs: dict[Key, dict[Point, str]] = {}
+        self.links: dict[tuple[Key, Point], Link] = {}
+        self.marks: dict[str, tuple[Key, Point]] = {}
+        # In-level walking distances, dropped whenever that level's map changes
+        self.paths: dict[Key, dict[tuple[Point, Point], int]] = {}
+
+        self.load()
+        nh.level_listeners.append(self.arrive)
+        nh.map_listeners.append(self.observe)
+
+    def load(self) -> None:
+        db = self.knowledge.db
+        with self.knowledge.lock:
+            db.executescript(SCHEMA)
+            for branch, dlvl, x, y, char in db.execute(
+                    'SELECT branch, dlvl, x, y, char FROM dungeon_stairs WHERE game = ?',
+                    (self.game,)):
+                self.stairs.setdefault((branch, dlvl), {})[Point(x, y)] = char
+            for branch, dlvl, x, y, to_branch, to_dlvl, to_x, to_y in db.execute(
+                    'SELECT branch, dlvl, x, y, to_branch, to_dlvl, to_x, to_y FROM dungeon_links '
+                    'WHERE game = ?', (self.game,)):
+                self.links[((branch, dlvl), Point(x, y))] = Link((to_branch, to_dlvl),
+                                                                  Point(to_x, to_y))
+            for name, branch, dlvl, x, y in db.execute(
+                    'SELECT name, branch, dlvl, x, y FROM dungeon_marks WHERE game = ?',
+                    (self.game,)):
+                self.marks[name] = ((branch, dlvl), Point(x, y))
+
+    @property
+    def branch(self) -> str:
+        # Kept on NetHack, the map memory is stored per branch too
+        return self.nh.branch
+
+    @branch.setter
+    def branch(self, branch: str) -> None:
+        self.nh.branch = branch
+
+    def key(self) -> Key:
+        return self.nh.level_key()
+
+    def add_stair(self, key: Key, point: Point, char: str) -> None:
+        level = self.stairs.setdefault(key, {})
+        if level.get(point) == char:
+            return
+        level[point] = char
+        with self.knowledge.lock:
+            self.knowledge.db.execute(
+                'INSERT OR REPLACE INTO dungeon_stairs VALUES (?, ?, ?, ?, ?, ?)',
+                (self.game, *key, point.x, point.y, char))
+            self.knowledge.db.commit()
+
+    def add_link(self, key: Key, stair: Point, link: Link) -> None:
+        if self.links.get((key, stair)) == link:
+            return
+        self.links[(key, stair)] = link
+        with self.knowledge.lock:
+            self.knowledge.db.execute(
+                'INSERT OR REPLACE INTO dungeon_links VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.game, *key, stair.x, stair.y, *link.to, link.arrival.x, link.arrival.y))
+            self.knowledge.db.commit()
+
+    def mark(self, name: str) -> None:
+        self.marks[name] = (self.key(), self.nh.pos)
+        with self.knowledge.lock:
+            self.knowledge.db.execute(
+                'INSERT OR REPLACE INTO dungeon_marks VALUES (?, ?, ?, ?, ?, ?)',
+                (self.game, name, *self.key(), self.nh.pos.x, self.nh.pos.y))
+            self.knowledge.db.commit()
+        print(f'Marked {name} at {self.key()} {self.nh.pos}')
+
+    def detect(self, previous: str) -> str:
+        for branch, detector in self.detectors.items():
+            if detector(self.nh):
+                return branch
+        # Leaving a detected branch can only lead back to the main dungeon
+        return MAIN if previous in self.detectors else previous
+
+    def arrive(self, dlvl: int, pos: Point | None) -> None:
+        # Called by NetHack once the new level is on screen, with where we left the old one
+        old = (self.branch, dlvl)
+        link = self.links.get((old, pos)) if pos else None
+        if link and link.to[1] == self.nh.dlvl:
+            self.branch = link.to[0]
+        else:
+            self.branch = self.detect(self.branch)
+
+        char = self.stairs.get(old, {}).get(pos) if pos else None
+        if pos and char and self.nh.dlvl - dlvl == STAIRS[char]:
+            # Stairs come in pairs: we stand on the way back
+            new = self.key()
+            self.add_link(old, pos, Link(new, self.nh.pos))
+            self.add_stair(new, self.nh.pos, OPPOSITE[char])
+            self.add_link(new, self.nh.pos, Link(old, pos))
+        print(f'Level {self.key()}')
+
+    def observe(self, rows: set[int]) -> None:
+        nh = self.nh
+        key = self.key()
+        self.paths.pop(key, None)
+        for y in rows:
+            text = nh.term.line(y)[nh.START.x:nh.START.x + nh.WIDTH]
+            if '<' not in text and '>' not in text:
+                continue
+            for x, c in enumerate(text):
+                if c in STAIRS:
+                    self.add_stair(key, Point(x, y - nh.START.y), c)
+
+    def distance(self, key: Key, src: Point | None, dst: Point) -> int:
+        if src is None:
+            return self.UNKNOWN_COST
+        cache = self.paths.setdefault(key, {})
+        if (src, dst) not in cache:
+            cache[(src, dst)] = self.walk(key, src, dst)
+        return cache[(src, dst)]
+
+    def walk(self, key: Key, src: Point, dst: Point) -> int:
+        # Breadth-first over the remembered map, travel can't path through the unknown either
+        cells = self.knowledge.level(key).cells
+        seen = {src}
+        frontier = [src]
+        steps = 0
+        while frontier:
+            if dst in seen:
+                return steps
+            steps += 1
+            nxt = []
+            for p in frontier:
+                for d in STEPS:
+                    q = p + d
+                    glyph = cells.get(q)
+                    if q in seen or not glyph or glyph.char in WALLS:
+                        continue
+                    seen.add(q)
+                    nxt.append(q)
+            frontier = nxt
+        # Not walkable on what we remember: guess
+        return max(abs(dst.x - src.x), abs(dst.y - src.y)) * 2
+
+    def route(self, dst: Key) -> list[Hop] | None:
+        start = (self.key(), self.nh.pos)
+        best: dict[Node, int] = {start: 0}
+        parent: dict[Node, tuple[Node, Hop] | None] = {start: None}
+        heap: list[tuple[int, int, Key, Point | None]] = [(0, 0, *start)]
+        tick = 0
+
+        while heap:
+            cost, _, key, pos = heapq.heappop(heap)
+            if cost > best[(key, pos)]:
+                continue
+            if key == dst:
+                hops = []
+                node: Node = (key, pos)
+                while (step := parent[node]) is not None:
+                    node, hop = step
+                    hops.append(hop)
+                return hops[::-1]
+
+            for stair, char in self.stairs.get(key, {}).items():
+                if link := self.links.get((key, stair)):
+                    to, arrival = link.to, link.arrival
+                else:
+                    to, arrival = (key[0], key[1] + STAIRS[char]), None
+                if to[1] < 1:
+                    continue # the up stairs of level 1 leave the dungeon
+                new = cost + self.distance(key, pos, stair) + 1
+                if new >= best.get((to, arrival), new + 1):
+                    continue
+                best[(to, arrival)] = new
+                parent[(to, arrival)] = ((key, pos), Hop(key, stair, char))
+                tick += 1
+                heapq.heappush(heap, (new, tick, to, arrival))
+        return None
+
+    def travel(self, dst: Key, pos: Point | None = None) -> bool:
+        if not (hops := self.route(dst)):
+            if self.key() != dst:
+                print(f'No known way from {self.key()} to {dst}')
+                return False
+            hops = []
+        print('Route: ' + ' '.join(f'{hop.level[0]}:{hop.level[1]}{hop.char}' for hop in hops))
+
+        for i, hop in enumerate(hops):
+            tasks.report(i, len(hops), 'levels')
+            if not self.nh.climb(hop.stair, hop.char):
+                return False
+        if pos and self.nh.pos != pos:
+            return self.nh.go_to(pos)
+        return True
+
+    def go_to_mark(self, name: str) -> bool:
+        if name not in self.marks:
+            print(f'Nothing marked as {name}')
+            return False
+        return self.travel(*self.marks[name])
+
+    def go_to_branch(self, branch: str) -> bool:
+        # The first level of a branch is the one we entered it by
+        entries = [link.to for (key, _), link in self.links.items()
+                   if key[0] != branch and link.to[0] == branch]
+        if not entries:
+            print(f'{branch} has not been visited yet')
+            return False
+        return self.travel(entries[0])
@@ -1,15 +1,22 @@
 # mypy: disable-error-code="misc"
 
+import abc
+import codecs
+import os
+import re
+import select
+import sys
+import termios
 import threading
+import tty
 import queue
+import traceback
 
-from typing import Callable
+from functools import partial
+from pathlib import Path
+from typing import Callable, Final
 from dataclasses import dataclass
 
-from Xlib import X, XK, display
-from Xlib.ext import record
-from Xlib.protocol import rq
-
 
 @dataclass(frozen=True)
 class State:
@@ -30,38 +37,209 @@ class State:
     def __or__(self, other: 'State') -> 'State':
         return State(self.state | other.state)
 
+# No modifier held, match patterns need a name: a bare State() class pattern matches any state
+Plain: State = State()
 Shift: State = State(1)
 Ctrl: State = State(4)
 Alt: State = State(8)
 
-class Keyboard:
+Handler = Callable[[], None]
+Emit = Callable[[str, State], None]
 
+MODIFIERS: Final[dict[str, State]] = {'shift': Shift, 'ctrl': Ctrl, 'alt': Alt}
+
+class Backend(abc.ABC):
+    # Produces (key, state) pairs named like X keysyms, until stopped or out of input
     def __init__(self) -> None:
-        self.local_dpy = display.Display()
-        self.record_dpy = display.Display()
-        self.callbacks: list[Callable[[str, State]]] = []
-        self.events: dict[tuple[str, State], threading.Event] = {}
-        self.queue: queue.Queue[tuple[str, State]] = queue.Queue()
+        self.stopped = threading.Event()
+
+    @abc.abstractmethod
+    def run(self, emit: Emit) -> None:
+        pass
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+class NullBackend(Backend):
+    # No input at all, for tools that drive the bot themselves
+    def run(self, emit: Emit) -> None:
+        self.stopped.wait()
+
+class TtyBackend(Backend):
+    SEQUENCES: Final[dict[str, str]] = {
+        '\x1b[A': 'Up', '\x1b[B': 'Down', '\x1b[C': 'Right', '\x1b[D': 'Left',
+        '\x1bOP': 'F1', '\x1bOQ': 'F2', '\x1bOR': 'F3', '\x1bOS': 'F4',
+        '\x1b[15~': 'F5', '\x1b[17~': 'F6', '\x1b[18~': 'F7', '\x1b[19~': 'F8',
+        '\x1b[20~': 'F9', '\x1b[21~': 'F10', '\x1b[23~': 'F11', '\x1b[24~': 'F12',
+    }
+    CHARS: Final[dict[str, tuple[str, State]]] = {
+        '\r': ('Return', State()),
+        '\n': ('Return', Ctrl), # Ctrl+J, the only Ctrl+Return a terminal can send
+        '\x1c': ('Escape', Ctrl), # Ctrl+Backslash, a terminal can't send Ctrl+Escape at all
+        '\x1b': ('Escape', State()),
+        '\t': ('Tab', State()),
+        '\x7f': ('BackSpace', State()),
+        ' ': ('space', State()),
+        '.': ('period', State()),
+        ',': ('comma', State()),
+        '-': ('minus', State()),
+    }
+    # One key each: a CSI or SS3 sequence, Alt plus a char, or a plain char
+    TOKEN: Final[re.Pattern[str]] = re.compile(
+        r'\x1b(?:\[[0-?]*[ -/]*[@-~]|O.|[^\[O])|[^\x1b]', re.S)
+    # Keys a plain tty can't tell apart, like Shift+space, when the terminal reports them
+    # as CSI u (ESC [ 32 ; 2 u) or xterm modifyOtherKeys (ESC [ 27 ; 2 ; 32 ~)
+    MODIFIED: Final[re.Pattern[str]] = re.compile(r'\x1b\[(?:27;(\d+);(\d+)~|(\d+);(\d+)u)')
+    # A lone ESC is the Escape key when nothing follows it this quickly
+    ESC_TIMEOUT: Final[float] = 0.05
+
+    def __init__(self, fd: int | None = None) -> None:
+        super().__init__()
+        self.fd = sys.stdin.fileno() if fd is None else fd
+
+    def split(self, pending: str) -> tuple[list[str], str]:
+        # Whole keys, and the tail that may be the start of an escape sequence
+        tokens = []
+        i = 0
+        while i < len(pending) and (m := self.TOKEN.match(pending, i)):
+            tokens.append(m.group())
+            i = m.end()
+        return tokens, pending[i:]
+
+    def modified(self, m: re.Match[str]) -> list[tuple[str, State]]:
+        mods, code = (m.group(1), m.group(2)) if m.group(1) else (m.group(4), m.group(3))
+        bits = int(mods) - 1
+        state = State((Shift.state if bits & 1 else 0) | (Alt.state if bits & 2 else 0)
+                      | (Ctrl.state if bits & 4 else 0))
+        return [(key, base | state) for key, base in self.parse(chr(int(code)))]
+
+    def parse(self, chunk: str) -> list[tuple[str, State]]:
+        if chunk in self.SEQUENCES:
+            return [(self.SEQUENCES[chunk], State())]
+        if m := self.MODIFIED.fullmatch(chunk):
+            return self.modified(m)
+        if len(chunk) == 2 and chunk[0] == '\x1b':
+            return [(key, state | Alt) for key, state in self.parse(chunk[1])]
+        if len(chunk) > 2 and chunk[0] == '\x1b':
+            return [] # a sequence for a key we don't name
+
+        keys = []
+        for c in chunk:
+            if c in self.CHARS:
+                keys.append(self.CHARS[c])
+            elif ord(c) < 32:
+                keys.append((chr(ord(c) + 96), Ctrl))
+            elif c.isupper():
+                keys.append((c.lower(), Shift))
+            else:
+                keys.append((c, State()))
+        return keys
+
+    def run(self, emit: Emit) -> None:
+        decoder = codecs.getincrementaldecoder('utf8')(errors='ignore')
+        pending = ''
+        old = termios.tcgetattr(self.fd)
+        tty.setraw(self.fd)
+        # Keys arrive raw, but print() output keeps its newline translation
+        mode = termios.tcgetattr(self.fd)
+        mode[tty.OFLAG] |= termios.OPOST
+        termios.tcsetattr(self.fd, termios.TCSANOW, mode)
+        try:
+            while not self.stopped.is_set():
+                # Pasted or fast input arrives several keys per read, a sequence may be split
+                if select.select([self.fd], [], [], self.ESC_TIMEOUT if pending else 0.1)[0]:
+                    pending += decoder.decode(os.read(self.fd, 1024))
+                    tokens, pending = self.split(pending)
+                elif pending:
+                    # Nothing completed the sequence: its first char stands alone
+                    tokens, pending = self.split(pending[1:])
+                    tokens.insert(0, '\x1b')
+                else:
+                    continue
+                for token in tokens:
+                    for key, state in self.parse(token):
+                        emit(key, state)
+        finally:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, old)
+
+class ScriptedBackend(Backend):
+    # One key per line: `<delay seconds> <key> [shift|ctrl|alt ...]`, `#` starts a comment
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.script: list[tuple[float, str, State]] = []
+        with open(path, 'r', encoding='utf8') as fp:
+            for line in fp:
+                if not (words := line.split('#', 1)[0].split()):
+                    continue
+                state = State()
+                for mod in words[2:]:
+                    state |= MODIFIERS[mod.lower()]
+                self.script.append((float(words[0]), words[1], state))
+
+    def run(self, emit: Emit) -> None:
+        for delay, key, state in self.script:
+            if self.stopped.wait(delay):
+                return
+            emit(key, state)
+
+class LazyBackend(Backend):
+    # Builds the real backend on the input thread when it starts running,
+    # so its imports and connections stay off the startup path
+    def __init__(self, factory: Callable[[], Backend]) -> None:
+        super().__init__()
+        self.factory = factory
+        self.backend: Backend | None = None
+        self.lock = threading.Lock()
+
+    def run(self, emit: Emit) -> None:
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.backend = self.factory()
+        self.backend.run(emit)
+
+    def stop(self) -> None:
+        with self.lock:
+            super().stop()
+            if self.backend:
+                self.backend.stop()
+
+def x_backend() -> Backend:
+    # Xlib is only needed, and only imported, when listening to X
+    from xrecord import XRecordBackend # pylint: disable=import-outside-toplevel
+    return XRecordBackend()
+
+def default_backend() -> Backend:
+    return LazyBackend(x_backend)
+
+def backend_from_spec(spec: str) -> Backend:
+    # 'x', 'tty' or 'script:<path>'
+    match spec.split(':', 1):
+        case ['x']:
+            return default_backend()
+        case ['tty']:
+            return TtyBackend()
+        case ['script', path]:
+            return ScriptedBackend(Path(path))
+        case _:
+            raise ValueError(f'Unknown input backend: {spec}')
 
-        # Check if the extension is present
-        if not self.record_dpy.has_extension('RECORD'):
-            raise ValueError('RECORD extension not found')
-
-        # Create a recording context; we only want key and mouse events
-        self.context = self.record_dpy.record_create_context(
-                0,
-                [record.AllClients],
-                [{
-                        'core_requests': (0, 0),
-                        'core_replies': (0, 0),
-                        'ext_requests': (0, 0, 0, 0),
-                        'ext_replies': (0, 0, 0, 0),
-                        'delivered_events': (0, 0),
-                        'device_events': (X.KeyPress, X.KeyPress),
-                        'errors': (0, 0),
-                        'client_started': False,
-                        'client_died': False,
-                }])
+class Keyboard:
+    # pylint: disable=too-many-instance-attributes
+    # One worker: handlers run in the order their keys came in, never two at once
+    WORKERS: Final[int] = 1
+    QUEUE_SIZE: Final[int] = 64
+
+    def __init__(self, backend: Backend | None = None) -> None:
+        self.backend = backend or default_backend()
+        self.callbacks: list[Callable[[str, State], None]] = []
+        self.bindings: dict[tuple[str, State], list[Handler]] = {}
+        self.events: dict[tuple[str, State], list[threading.Event]] = {}
+        self.events_lock = threading.Lock()
+        self.queue: queue.Queue[tuple[str, State]] = queue.Queue()
+        # Handlers run off the input thread, a slow one must not stall input capture
+        self.jobs: queue.Queue[Handler] = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.workers: list[threading.Thread] = []
 
     def add_callback(self, callback: Callable[[str, State], None]) -> None:
         self.callbacks.append(callback)
@@ -69,54 +247,54 @@ class Keyboard:
     def remove_callback(self, callback: Callable[[str, State], None]) -> None:
         self.callbacks.remove(callback)
 
-    def lookup_keysym(self, keysym: int) -> str:
-        for name in dir(XK):
-            if name[:3] == 'XK_' and getattr(XK, name) == keysym:
-                return name[3:]
-        return f'[{keysym}]'
-
-    def record_callback(self, reply: rq.DictWrapper) -> None:
-        if reply.category != record.FromServer:
-            return
-        if reply.client_swapped:
-            # received swapped protocol data, cowardly ignored
-            return
-        if not reply.data or reply.data[0] < 2:
-            # not an event
-            return
-
-        data = reply.data
-        while len(data):
-            event, data = rq.EventField('').parse_binary_value(
-                data, self.record_dpy.display, None, None)
-
-            if event.type in [X.KeyPress, X.KeyRelease]:
-                keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
-                if not keysym:
-                    continue
+    def bind(self, key: str, state: State, handler: Handler) -> None:
+        self.bindings.setdefault((key, state), []).append(handler)
 
-                key = self.lookup_keysym(keysym)
-                state = State(event.state)
-                for callback in self.callbacks:
-                    callback(key, state)
-                if ev := self.events.get((key, state)):
-                    ev.set()
-                self.queue.put_nowait((key, state))
+    def unbind(self, key: str, state: State, handler: Handler) -> None:
+        self.bindings[(key, state)].remove(handler)
+
+    def dispatch(self, job: Handler) -> None:
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            print(f'Keyboard: handler queue is full, dropping {job}')
+
+    def work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                job()
+            except Exception: # pylint: disable=broad-exception-caught
+                traceback.print_exc()
+
+    def handle_key(self, key: str, state: State) -> None:
+        for callback in self.callbacks:
+            self.dispatch(partial(callback, key, state))
+        for handler in self.bindings.get((key, state), ()):
+            self.dispatch(handler)
+        with self.events_lock:
+            for ev in self.events.get((key, state), ()):
+                ev.set()
+        self.queue.put_nowait((key, state))
 
     def start(self) -> None:
-        # Enable the context; this only returns after a call to
-        # record_disable_context, while calling the callback function in the
-        # meantime
-        self.record_dpy.record_enable_context(self.context, self.record_callback)
+        for i in range(self.WORKERS):
+            worker = threading.Thread(target=self.work, name=f'keyboard-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.backend.run(self.handle_key)
 
-        # Finally free the context
-        self.record_dpy.record_free_context(self.context)
+    def stop(self) -> None:
+        self.backend.stop()
 
     def wait(self, key: str, state: State = State()) -> None:
         event = threading.Event()
-        self.events[(key, state)] = event
+        with self.events_lock:
+            self.events.setdefault((key, state), []).append(event)
         event.wait()
-        self.events.pop((key, state))
+        with self.events_lock:
+            self.events[(key, state)].remove(event)
 
     def next(self) -> tuple[str, State]:
         return self.queue.get(block = True)
@@ -0,0 +1,175 @@
+import copy
+import sqlite3
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter, time
+from typing import Final, TypeAlias
+
+from point import Point
+from stats import STATS, COUNTERS
+from term import Glyph, Attr, DEC_CHARSET
+
+KNOWLEDGE_DB: Final[Path] = Path(__file__).parents[1] / 'tmp/knowledge.sqlite'
+
+# Sokoban and the Mines reuse the main dungeon's depths, a level is its branch and Dlvl
+Key: TypeAlias = tuple[str, int]
+
+MAIN: Final[str] = 'main'
+
+# Bumped whenever the tables below change, older tables are dropped
+SCHEMA_VERSION: Final[int] = 2
+OLD_TABLES: Final[list[str]] = ['cells', 'visited', 'stairs', 'status']
+
+SCHEMA: Final[str] = '''
+CREATE TABLE IF NOT EXISTS cells (
+    game TEXT, branch TEXT, dlvl INTEGER, x INTEGER, y INTEGER, char TEXT, attr INTEGER,
+    PRIMARY KEY (game, branch, dlvl, x, y)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS visited (
+    game TEXT, branch TEXT, dlvl INTEGER, bitmap BLOB,
+    PRIMARY KEY (game, branch, dlvl)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stairs (
+    game TEXT, branch TEXT, dlvl INTEGER, x INTEGER, y INTEGER, char TEXT,
+    PRIMARY KEY (game, branch, dlvl, x, y)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status (
+    game TEXT, branch TEXT, dlvl INTEGER, time REAL, line TEXT
+);
+'''
+
+STAIR_CHARS: Final[str] = '<>'
+# Dungeon features only: monsters and items move or get picked up, what's under them stays
+TERRAIN: Final[frozenset[str]] = frozenset(
+    [DEC_CHARSET[code] for code in range(0x6a, 0x79)]
+    + ['·', '▒', '#', '.', '<', '>', '{', '}', '_', '\\', '^', '+', '|', '-'])
+
+@dataclass
+class Level:
+    key: Key
+    width: int
+    cells: dict[Point, Glyph] = field(default_factory=dict)
+    visited: bytearray = field(default_factory=bytearray)
+    stairs: dict[Point, str] = field(default_factory=dict)
+    # Written on the next flush
+    dirty: set[Point] = field(default_factory=set)
+    visited_dirty: bool = False
+
+    def is_visited(self, point: Point) -> bool:
+        idx = point.y * self.width + point.x
+        return bool(self.visited[idx >> 3] & 1 << (idx & 7))
+
+    def visited_points(self) -> list[Point]:
+        return [Point(idx % self.width, idx // self.width)
+                for idx in range(len(self.visited) * 8)
+                if self.visited[idx >> 3] & 1 << (idx & 7)]
+
+class Knowledge:
+    # Remembered map, visited bitmap and stairs of every level, kept in SQLite.
+    # Levels load on first use, changes are written in batches.
+    # Without a game name nothing tells this game from the last one: memory only.
+    FLUSH_INTERVAL: Final[float] = 2.0
+
+    def __init__(self, game: str | None, width: int, height: int,
+                 path: Path = KNOWLEDGE_DB) -> None:
+        self.game = game or 'session'
+        self.width = width
+        self.height = height
+        self.lock = threading.Lock()
+        self.levels: dict[Key, Level] = {}
+        self.flushed = perf_counter()
+
+        if not game:
+            print('NH_GAME is not set, the map is remembered for this session only')
+        self.db = sqlite3.connect(path if game else ':memory:', check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            for table in OLD_TABLES:
+                self.db.execute(f'DROP TABLE IF EXISTS {table}')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.db.executescript(SCHEMA)
+
+    def level(self, key: Key) -> Level:
+        with self.lock:
+            if (level := self.levels.get(key)) is None:
+                level = self.levels[key] = self.load(key)
+            return level
+
+    def load(self, key: Key) -> Level:
+        with STATS.time('knowledge_load'):
+            level = Level(key, self.width, visited=bytearray((self.width * self.height + 7) // 8))
+            where = (self.game, *key)
+            for x, y, char, attr in self.db.execute(
+                    'SELECT x, y, char, attr FROM cells '
+                    'WHERE game = ? AND branch = ? AND dlvl = ?', where):
+                level.cells[Point(x, y)] = Glyph(char, Attr.unpack(attr))
+            for x, y, char in self.db.execute(
+                    'SELECT x, y, char FROM stairs '
+                    'WHERE game = ? AND branch = ? AND dlvl = ?', where):
+                level.stairs[Point(x, y)] = char
+            if row := self.db.execute(
+                    'SELECT bitmap FROM visited WHERE game = ? AND branch = ? AND dlvl = ?',
+                    where).fetchone():
+                level.visited[:len(row[0])] = row[0]
+            return level
+
+    def remember(self, key: Key, point: Point, glyph: Glyph | None) -> None:
+        if glyph is None or glyph.char not in TERRAIN:
+            return
+        level = self.level(key)
+        if level.cells.get(point) == glyph:
+            return
+        with self.lock:
+            level.cells[point] = Glyph(glyph.char, copy.copy(glyph.attr))
+            level.dirty.add(point)
+            if glyph.char in STAIR_CHARS:
+                level.stairs[point] = glyph.char
+            COUNTERS['knowledge_cells'] += 1
+
+    def visit(self, key: Key, point: Point) -> bool:
+        level = self.level(key)
+        idx = point.y * self.width + point.x
+        if level.visited[idx >> 3] & 1 << (idx & 7):
+            return False
+        with self.lock:
+            level.visited[idx >> 3] |= 1 << (idx & 7)
+            level.visited_dirty = True
+        return True
+
+    def snapshot(self, key: Key, lines: list[str]) -> None:
+        with self.lock:
+            self.db.executemany('INSERT INTO status VALUES (?, ?, ?, ?, ?)',
+                                [(self.game, *key, time(), line) for line in lines])
+            self.db.commit()
+
+    def flush(self, force: bool = False) -> None:
+        if not force and perf_counter() - self.flushed < self.FLUSH_INTERVAL:
+            return
+        with self.lock, STATS.time('knowledge_flush'):
+            self.flushed = perf_counter()
+            cells, stairs, visited = [], [], []
+            for level in self.levels.values():
+                for point in level.dirty:
+                    glyph = level.cells[point]
+                    cells.append((self.game, *level.key, point.x, point.y,
+                                  glyph.char, glyph.attr.pack()))
+                    if point in level.stairs:
+                        stairs.append((self.game, *level.key, point.x, point.y,
+                                       level.stairs[point]))
+                level.dirty.clear()
+                if level.visited_dirty:
+                    visited.append((self.game, *level.key, bytes(level.visited)))
+                    level.visited_dirty = False
+            if not (cells or stairs or visited):
+                return
+            self.db.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)', cells)
+            self.db.executemany('INSERT OR REPLACE INTO stairs VALUES (?, ?, ?, ?, ?, ?)', stairs)
+            self.db.executemany('INSERT OR REPLACE INTO visited VALUES (?, ?, ?, ?)', visited)
+            self.db.commit()
+
+    def close(self) -> None:
+        self.flush(force=True)
+        self.db.close()
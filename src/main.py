@@ -1,16 +1,39 @@
+# pylint: disable=wrong-import-position,import-outside-toplevel
+from time import perf_counter
+# Taken before the imports below, they count towards startup
+STARTED = perf_counter()
+
+import atexit
 import logging
+import os
 from threading import Thread
 from pathlib import Path
 
 import sokoban
 from term import Term
 from nethack import NetHack
+from stats import STATS, Startup
+from profiler import Profiler
+from tasks import Executor
+from dungeon import Dungeon
 
 import keyboard
-from keyboard import Keyboard
+from keyboard import Keyboard, backend_from_spec
+
 
+# Seconds from launch to the key loop, NH_STARTUP_BUDGET overrides it
+STARTUP_BUDGET = float(os.environ.get('NH_STARTUP_BUDGET', '0.25'))
+
+def report(startup: Startup) -> None:
+    if startup.total() > STARTUP_BUDGET:
+        print(startup.report(STARTUP_BUDGET))
+    else:
+        print(f'Started in {startup.total() * 1000:.0f}ms')
 
 def main() -> None:
+    startup = Startup(STARTED)
+    startup.mark('imports')
+
     logger = logging.getLogger('term')
     logger.setLevel(logging.DEBUG)
     logger.addHandler(logging.FileHandler(
@@ -20,29 +43,93 @@ def main() -> None:
     # logger.setLevel(logging.INFO)
     # logger.addHandler(logging.StreamHandler())
 
-    term = Term(logger, fifo=True)
-    kb = Keyboard()
+    # NH_TERM=process parses in a child process and shares the screen through shared memory
+    shared = os.environ.get('NH_TERM') == 'process'
+    # NH_CORE=asyncio runs parser, follow and actions on one event loop, so it needs a local Term
+    use_asyncio = os.environ.get('NH_CORE') == 'asyncio'
+    if use_asyncio and shared:
+        raise SystemExit('NH_CORE=asyncio parses on its own event loop, '
+                         'it does not work with NH_TERM=process')
+    if shared:
+        from shmterm import SharedTerm
+        shared_term = SharedTerm(logger, fifo=True)
+        atexit.register(shared_term.close)
+        term: Term = shared_term
+    else:
+        term = Term(logger, fifo=True)
+    startup.mark('term')
+    # NH_INPUT selects the input backend: x (default), tty or script:<path>
+    kb = Keyboard(backend_from_spec(os.environ.get('NH_INPUT', 'x')))
+    startup.mark('keyboard')
     nh = NetHack(term, kb)
+    # Read while the game starts up, Ctrl+S only waits if it is pressed first
+    sokoban.preload()
+    startup.mark('nethack')
+    profiler = Profiler(kb)
+    # Sokoban levels are recognised by their solution, everything else stays in its branch
+    dungeon = Dungeon(nh, {
+        sokoban.SOKOBAN: lambda nh: sokoban.solution_index().identify(nh) is not None})
 
-    t1 = Thread(target=term.start, args=(), daemon=True)
-    t1.start()
+    # Actions run off the key loop, so hotkeys stay live while they do
+    executor = Executor(kb)
+    executor.wakeups.append(nh.resume)
 
-    t2 = Thread(target=kb.start, args=(), daemon=True)
-    t2.start()
+    atexit.register(STATS.dump)
 
-    t3 = Thread(target=nh.follow, args=(), daemon=True)
-    t3.start()
+    # NH_SERVER=1 shares the parsed screen with local tools over tmp/screen.sock
+    if os.environ.get('NH_SERVER') == '1':
+        from server import ScreenServer
+        server = ScreenServer(term, nh.press, nh.status)
+        server.start()
+        atexit.register(server.stop)
+    atexit.register(nh.knowledge.close)
+    atexit.register(profiler.stop)
+    startup.mark('services')
 
-    while True:
-        key, state = kb.next()
+    def handle(key: str, state: keyboard.State) -> bool:
         match (key, state):
             case ('s', keyboard.Ctrl):
-                if nh:
-                    sokoban.solve(nh)
+                executor.submit('sokoban', lambda: sokoban.solve(nh))
+            case ('s', keyboard.Alt):
+                executor.submit('sokoban branch', lambda: sokoban.solve_branch(nh))
             case ('space', keyboard.Shift):
-                if nh:
-                    nh.start_explore()
+                executor.submit('explore', nh.start_explore)
+            case ('F2', keyboard.Plain):
+                dungeon.mark('stash')
+            case ('F3', keyboard.Plain):
+                executor.submit('stash', lambda: dungeon.go_to_mark('stash'))
+            case ('F4', keyboard.Plain):
+                executor.submit('to sokoban', lambda: dungeon.go_to_branch(sokoban.SOKOBAN))
+            case ('F9', keyboard.Plain):
+                print(STATS.report())
+                STATS.dump()
             case ('Escape', keyboard.Ctrl):
-                break
+                executor.abort()
+                return False
+        return True
+
+    if use_asyncio:
+        import asyncio
+        from aio import Core
+        core = Core(term, kb, nh, executor, handle)
+        startup.mark('asyncio')
+        report(startup)
+        asyncio.run(core.main())
+        return
+
+    t1 = Thread(target=term.start, args=(), name='term', daemon=True)
+    t1.start()
+
+    t2 = Thread(target=kb.start, args=(), name='keyboard', daemon=True)
+    t2.start()
+
+    t3 = Thread(target=nh.follow, args=(), name='follow', daemon=True)
+    t3.start()
+    startup.mark('threads')
+    report(startup)
+
+    while handle(*kb.next()):
+        pass
+    executor.join(1.0)
 
 main()
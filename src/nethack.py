@@ -1,13 +1,23 @@
 import logging
+import os
 import subprocess
 import re
 import string
 
-from threading import Condition
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from threading import Condition, Event, Thread
+from time import perf_counter
+from typing import Callable, Self, Sequence
 
 from point import Point
-from term import Term, Glyph, DEC_CHARSET
+from knowledge import Knowledge, Key, MAIN
+from screen import Classifier, MENU
+from responder import Responder
+from stats import STATS, COUNTERS
+from term import Term, Glyph, Change, Subscription, DEC_CHARSET, Unused, ROW, CURSOR, FRAME
 import keyboard
+import tasks
 from keyboard import Keyboard
 
 class NetHack:
@@ -21,6 +31,14 @@ class NetHack:
 
     ENEMIES = list(string.ascii_letters) + ['\'', '&', ':']
 
+    STATUS_ROWS = (2, 3)
+
+    CHECK_TIMEOUT = 0.5
+    STALL_POLL = 0.05
+    OPTION_TIMEOUT = 2.0
+    CLIMB_TIMEOUT = 5.0
+    CLIMB_ATTEMPTS = 2
+
     DIRECTIONS = {
         'd': ('j', Point( 0,  1)),
         'u': ('k', Point( 0, -1)),
@@ -29,32 +47,39 @@ class NetHack:
 
         'ul': ('y', Point( -1,  -1)),
         'ur': ('u', Point( 1, -1)),
-        'dl': ('n', Point(-1,  1)),
-        'dr': ('b', Point( 1,  1)),
+        'dl': ('b', Point(-1,  1)),
+        'dr': ('n', Point( 1,  1)),
     }
 
-    def __init__(self, term: Term, kb: Keyboard) -> None:
+    def __init__(self, term: Term, kb: Keyboard, knowledge: Knowledge | None = None) -> None:
         self.pos: Point
         self.symbol: Glyph
         self.finished_init = False
         self.term = term
+        self.screen = Classifier(term, range(self.START.y, self.START.y + self.HEIGHT))
         self.keyboard = kb
         self.condition = Condition()
         self.skip = False
+        self.decisions = 0
         self.dlvl = -1
-        self.visited: dict[int, list[Point]] = {}
-
-        def handle_keys(key: str, state: keyboard.State) -> None:
-            match (key, state):
-                case ('Return', keyboard.Ctrl):
-                    with self.condition:
-                        self.condition.notify_all()
-                case ('Return', keyboard.Alt):
-                    with self.condition:
-                        self.skip = True
-                        self.condition.notify_all()
-
-        self.keyboard.add_callback(handle_keys)
+        # Set by the dungeon map once it tells the branches apart
+        self.branch = MAIN
+        # NH_GAME keeps the memory of several games apart, unset it lasts a session
+        self.knowledge = knowledge or Knowledge(os.environ.get('NH_GAME'), self.WIDTH, self.HEIGHT)
+        self.remembered_dlvl = -1
+        # Where we have stood on each level, restored from the knowledge store on arrival
+        self.visited: dict[Key, list[Point]] = {}
+        # Where we stood when the map was last remembered, the stairs we took on a level change
+        self.last_pos: Point | None = None
+        # Called with the level we left and our last position on it
+        self.level_listeners: list[Callable[[int, Point | None], None]] = []
+        # Called with the map rows that changed, after they are remembered
+        self.map_listeners: list[Callable[[set[int]], None]] = []
+
+        self.keyboard.bind('Return', keyboard.Ctrl, self.resume)
+        self.keyboard.bind('Return', keyboard.Alt, self.give_up)
+
+        self.responder = Responder(self)
 
     def read_pos(self) -> bool:
         glyph = self.term[self.term.cursor]
@@ -73,9 +98,7 @@ class NetHack:
         return True
 
     def at(self, point: Point) -> Glyph | None:
-        if point.x >= self.WIDTH:
-            return None
-        if point.y >= self.HEIGHT:
+        if not (0 <= point.x < self.WIDTH and 0 <= point.y < self.HEIGHT):
             return None
         return self.term[point + self.START]
 
@@ -93,13 +116,7 @@ class NetHack:
         return False
 
     def is_covered(self) -> bool:
-        for y in range(self.HEIGHT):
-            for x in range(self.WIDTH):
-                p = Point(x, y)
-                if self.is_wall(p) and (glyph := self.at(p)):
-                    if glyph.attr.fg_color == 5:
-                        return True
-        return False
+        return self.screen.covered
 
     def print(self) -> None:
         for y in range(self.HEIGHT):
@@ -112,6 +129,10 @@ class NetHack:
 
     def has_enemies(self) -> Glyph | None:
         self.term.do_yield()
+        return self.find_enemy()
+
+    def find_enemy(self) -> Glyph | None:
+        COUNTERS['full_map_scans'] += 1
         for y in range(self.HEIGHT):
             for x in range(self.WIDTH):
                 if Point(x, y) != self.pos:
@@ -120,53 +141,85 @@ class NetHack:
                         return glyph
         return None
 
+    def resume(self) -> None:
+        with self.condition:
+            self.decisions += 1
+            self.condition.notify_all()
+
+    def give_up(self) -> None:
+        with self.condition:
+            self.skip = True
+            self.decisions += 1
+            self.condition.notify_all()
+
     def wait(self) -> bool:
+        # Up to the human, so no timeout, but an abort still gets through
         with self.condition:
             self.skip = False
-            self.condition.wait()
-            return not self.skip
+            decisions = self.decisions
+            tasks.wait(self.condition, lambda: self.decisions != decisions)
+        return not self.skip
 
     def check(self, msg: str, pos: Point | None = None, symbol: Glyph | None = None) -> bool:
+        with STATS.time('check'):
+            return self._check(msg, pos, symbol)
+
+    def _check(self, msg: str, pos: Point | None = None, symbol: Glyph | None = None) -> bool:
+        tasks.checkpoint()
         if not pos:
             pos = self.pos
         if not symbol:
             symbol = self.symbol
 
-        cnt = 0
-        while self.at(pos) != symbol:
-            cnt += 1
-            self.term.do_yield()
-            if cnt > 500:
-                print(f'{msg}\n{pos}: {self.at(pos)} != {symbol}')
-                if not self.wait():
-                    return False
-                return self.check(msg, pos, symbol)
+        # Only changes of the checked row wake us up, instead of polling the screen
+        changes = self.term.subscribe([ROW], [(pos + self.START).y])
+        stalls = self.responder.stalls
+        try:
+            deadline = perf_counter() + self.CHECK_TIMEOUT
+            while self.at(pos) != symbol:
+                # A message the responder knows to be fatal ends the wait early
+                stalled = self.responder.stalls != stalls
+                if stalled or perf_counter() > deadline:
+                    if stalled:
+                        print(f'Stalled: "{self.responder.history[-1].text}"')
+                    print(f'{msg}\n{pos}: {self.at(pos)} != {symbol}')
+                    if not self.wait():
+                        return False
+                    return self._check(msg, pos, symbol)
+                changes.get(max(min(deadline - perf_counter(), self.STALL_POLL), 0))
+        finally:
+            self.term.unsubscribe(changes)
 
         if enemy := self.has_enemies():
             print(f'Map has enemies "{enemy}"!')
             self.wait()
-            return self.check(msg, pos, symbol)
+            return self._check(msg, pos, symbol)
 
         return True
 
-    def PRESS(self, c: str) -> str:
-        return f'screen -x -S "nethack" -X stuff "{c}"'
+    def PRESS(self, c: str) -> list[str]:
+        # An argv list: keys like $ or ` never reach a shell
+        return ['screen', '-x', '-S', 'nethack', '-X', 'stuff', c]
 
-    def run(self, command: str) -> None:
-        subprocess.run([command], shell=True, check=True)
+    def run(self, command: list[str]) -> None:
+        subprocess.run(command, check=True)
 
     def press(self, c: str) -> None:
-        self.run(self.PRESS(c))
+        tasks.checkpoint()
+        STATS.key_sent()
+        with STATS.time('press'):
+            self.run(self.PRESS(c))
 
-    def move_cursor(self, from_point: Point, to_point: Point) -> None:
+    def cursor_keys(self, from_point: Point, to_point: Point) -> str:
         diff = to_point - from_point
+        keys = ''
 
         while diff.y != 0:
             if diff.y > 0:
                 d = 'd'
             else:
                 d = 'u'
-            self.press(self.DIRECTIONS[d][0])
+            keys += self.DIRECTIONS[d][0]
             diff += self.DIRECTIONS[d][1] * (-1)
 
         while diff.x != 0:
@@ -174,10 +227,20 @@ class NetHack:
                 d = 'r'
             else:
                 d = 'l'
-            self.press(self.DIRECTIONS[d][0])
+            keys += self.DIRECTIONS[d][0]
             diff += self.DIRECTIONS[d][1] * (-1)
 
+        return keys
+
+    def move_cursor(self, from_point: Point, to_point: Point) -> None:
+        for key in self.cursor_keys(from_point, to_point):
+            self.press(key)
+
     def go_to(self, to_point: Point) -> bool:
+        with STATS.time('go_to'):
+            return self._go_to(to_point)
+
+    def _go_to(self, to_point: Point) -> bool:
         self.press('-')
         self.press('@')
         self.move_cursor(self.pos, to_point)
@@ -191,37 +254,109 @@ class NetHack:
 
         return self.pos == to_point
 
-    def set_option(self, option: str, value: str) -> None:
+    def climb(self, stair: Point, char: str) -> bool:
+        with STATS.time('climb'):
+            return self._climb(stair, char)
+
+    def _climb(self, stair: Point, char: str) -> bool:
+        for _ in range(self.CLIMB_ATTEMPTS):
+            before = self.dlvl
+            # Travel and the stair command go out as one write
+            keys = '' if self.pos == stair else '-@' + self.cursor_keys(self.pos, stair) + '.'
+            self.press(keys + char)
+
+            deadline = perf_counter() + self.CLIMB_TIMEOUT
+            while self.dlvl == before and perf_counter() < deadline:
+                tasks.checkpoint()
+                self.term.do_yield()
+            if self.dlvl != before:
+                return True
+            print(f'Still on Dlvl {self.dlvl} at {self.pos}, {char} is at {stair}')
+        return False
+
+    def set_option(self, option: str, value: str) -> bool:
+        with STATS.time('set_option'):
+            return self._set_option(option, value)
+
+    def _set_option(self, option: str, value: str) -> bool:
         self.press('O')
         page = 1
 
         while True:
-            while not (last := re.search(fr'\(Page {page} of (\d*)\)',
-                                         self.term.line(self.term.maxy - 1))):
-                self.term.do_yield()
+            mode = self.screen.wait(lambda m: m.kind == MENU and m.page == page,
+                                    self.OPTION_TIMEOUT)
+            if not mode:
+                print(f'Options menu page {page} did not show up, {option} is unchanged')
+                self.press('\x1b')
+                return False
 
             for line in self.term.lines():
                 if m := re.search(fr'([a-zA-Z])\) {option} ', line):
                     self.press(m.group(1))
 
             self.press(' ')
-            if int(last.group(1)) == page:
+            if mode.pages == page:
                 break
             page += 1
 
         self.press(value)
+        return True
+
+    def status_lines(self) -> list[str]:
+        return [self.term.line(y).strip() for y in self.STATUS_ROWS]
+
+    def status(self) -> dict[str, object]:
+        return {
+            'dlvl': self.dlvl,
+            'pos': [self.pos.x, self.pos.y] if self.finished_init else None,
+            'mode': asdict(self.screen.mode),
+            'covered': self.screen.covered,
+            'status': self.status_lines(),
+        }
+
+    def level_key(self) -> Key:
+        return (self.branch, self.dlvl)
+
+    def remember(self, rows: set[int]) -> None:
+        if self.dlvl < 0:
+            return # status line not seen yet, the map would land on the wrong level
+        if self.dlvl != self.remembered_dlvl:
+            previous, self.remembered_dlvl = self.remembered_dlvl, self.dlvl
+            rows = set(range(self.START.y, self.START.y + self.HEIGHT))
+            if previous >= 0:
+                # Listeners settle the branch before anything is stored under it
+                for level_listener in self.level_listeners:
+                    level_listener(previous, self.last_pos)
+            self.knowledge.snapshot(self.level_key(), self.status_lines())
+
+        key = self.level_key()
+        if key not in self.visited:
+            self.visited[key] = self.knowledge.level(key).visited_points()
+        for y in rows:
+            for x in range(self.WIDTH):
+                point = Point(x, y - self.START.y)
+                self.knowledge.remember(key, point, self.at(point))
+        if self.knowledge.visit(key, self.pos):
+            self.visited[key].append(self.pos)
+        self.knowledge.flush()
+        for map_listener in self.map_listeners:
+            map_listener(rows)
+        self.last_pos = self.pos
+
+    def subscribe_map(self) -> Subscription:
+        # The position only changes when the cursor moves, the map when its rows do
+        return self.term.subscribe([CURSOR, ROW], range(self.START.y, self.START.y + self.HEIGHT))
+
+    def track(self, changed: Sequence[Change | None]) -> None:
+        with STATS.time('follow'):
+            if self.is_covered() or (not self.read_pos()) or (not self.finished_init):
+                return
+            self.remember({c.row for c in changed if c and c.kind == ROW})
 
     def follow(self) -> None:
+        changes = self.subscribe_map()
         while True:
-            with self.term.redraw:
-                self.term.redraw.wait()
-
-                if self.is_covered() or (not self.read_pos()) or (not self.finished_init):
-                    continue
-
-                if self.dlvl not in self.visited:
-                    self.visited[self.dlvl] = []
-                self.visited[self.dlvl].append(self.pos)
+            self.track([changes.get(), *changes.drain()])
 
 
     def start_explore(self) -> None:
@@ -253,6 +388,150 @@ class NetHack:
     #     print('Nowhere to go!')
     #     return False
 
+@dataclass
+class Expect:
+    seq: int
+    keys: str
+    pos: Point
+    checks: list[tuple[Point, Glyph]] = field(default_factory=list)
+    sent: float = 0.0
+
+    def same(self, other: 'Expect') -> bool:
+        return self.pos == other.pos and self.checks == other.checks
+
+class Pipeline:
+    # Keeps up to `window` actions in flight, verifying them as frames arrive.
+    # Actions are numbered as they are sent and acknowledged up to a number, in order.
+    def __init__(self, nh: NetHack, window: int = 4, timeout: float = 2.0,
+                 metric: str | None = None) -> None:
+        self.nh = nh
+        self.window = window
+        self.timeout = timeout
+        # Histogram for the time from sending an action to seeing it on screen
+        self.metric = metric
+        self.inflight: deque[Expect] = deque()
+        self.sent = 0
+        self.acked = 0
+        self.failed: Expect | None = None
+        self.halted = False
+        # What the screen showed before the oldest action in flight
+        self.base = Expect(0, '', nh.pos)
+        self.progress = 0.0
+        self.condition = Condition()
+        self.stop = Event()
+        self.thread: Thread | None = None
+        # Pausing the task holds the ack clock, the game did nothing wrong meanwhile
+        self.task = tasks.current()
+        self.stalls = nh.responder.stalls
+
+    def __enter__(self) -> Self:
+        self.base = Expect(self.acked, '', self.nh.pos)
+        self.stalls = self.nh.responder.stalls
+        self.stop.clear()
+        self.thread = Thread(target=self.verify_loop, name='pipeline', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Unused) -> None:
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def holds(self, expect: Expect) -> bool:
+        if self.nh.at(expect.pos) != self.nh.symbol:
+            return False
+        return all(self.nh.at(pos) == glyph for pos, glyph in expect.checks)
+
+    def verify(self) -> None:
+        # Frames may skip states, a later action holding acknowledges all earlier ones.
+        # Unless an earlier one expects the very same screen: walking back to where we
+        # were proves nothing about the steps in between.
+        states = [self.base, *self.inflight]
+        for i in range(len(states) - 1, 0, -1):
+            expect = states[i]
+            if any(earlier.same(expect) for earlier in states[:i]):
+                continue
+            if self.holds(expect):
+                now = perf_counter()
+                while self.inflight and self.inflight[0].seq <= expect.seq:
+                    done = self.inflight.popleft()
+                    if self.metric:
+                        STATS.add(self.metric, now - done.sent)
+                self.acked = expect.seq
+                self.base = expect
+                self.progress = now
+                break
+
+        if self.task and not self.task.running.is_set():
+            self.progress = perf_counter()
+        if self.inflight and not self.failed:
+            head = self.inflight[0]
+            if perf_counter() - max(head.sent, self.progress) > self.timeout:
+                self.failed = head
+                print(f'Pipeline stalled on #{head.seq} "{head.keys}"\n'
+                      f'{head.pos}: {self.nh.at(head.pos)} != {self.nh.symbol}')
+
+    def stalled(self) -> bool:
+        # Same as check: a message the responder knows to be fatal ends the plan right away
+        if self.nh.responder.stalls == self.stalls:
+            return False
+        print(f'Stalled: "{self.nh.responder.history[-1].text}"')
+        return True
+
+    def verify_loop(self) -> None:
+        frames = self.nh.term.subscribe([FRAME])
+        try:
+            while not self.stop.is_set():
+                if frames.get(0.05):
+                    frames.drain()
+                with self.condition:
+                    self.verify()
+                    self.condition.notify_all()
+        finally:
+            self.nh.term.unsubscribe(frames)
+
+    def send(self, keys: str, pos: Point, checks: list[tuple[Point, Glyph]] | None = None) -> bool:
+        with self.condition:
+            tasks.wait(self.condition,
+                       lambda: self.sent - self.acked < self.window or bool(self.failed)
+                       or self.nh.responder.stalls != self.stalls, self.timeout * self.window)
+            if self.halted or self.stalled() or self.failed:
+                return self.abandon()
+            if self.sent - self.acked >= self.window:
+                return self.abandon()
+
+        # Same rule as check: nothing scripted happens with an enemy in sight
+        if enemy := self.nh.has_enemies():
+            print(f'Map has enemies "{enemy}"!')
+            with self.condition:
+                return self.abandon()
+
+        with self.condition:
+            self.sent += 1
+            self.inflight.append(Expect(self.sent, keys, pos, checks or [], perf_counter()))
+        self.nh.press(keys)
+        self.nh.pos = pos
+        return True
+
+    def drain(self) -> bool:
+        with self.condition:
+            tasks.wait(self.condition, lambda: self.acked == self.sent or bool(self.failed)
+                       or self.nh.responder.stalls != self.stalls, self.timeout * self.window)
+            if self.halted or self.stalled() or self.failed or self.acked != self.sent:
+                return self.abandon()
+            return True
+
+    def abandon(self) -> bool:
+        # Called with the condition held. Stops for good: the keys already sent still land,
+        # so wait for the screen to settle before the caller reads it to re-plan.
+        self.halted = True
+        tasks.wait(self.condition, lambda: not self.inflight, self.timeout)
+        if self.inflight:
+            print(f'Pipeline stopped with {len(self.inflight)} actions unverified')
+        self.inflight.clear()
+        return False
+
 def test() -> None:
     logging.basicConfig(
         filename='log.txt',
@@ -0,0 +1,83 @@
+import json
+import sys
+import threading
+
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Final
+
+import keyboard
+from keyboard import Keyboard
+from stats import COUNTERS
+
+PROFILE_STACKS: Final[Path] = Path(__file__).parents[1] / 'tmp/profile.collapsed'
+PROFILE_COUNTERS: Final[Path] = Path(__file__).parents[1] / 'tmp/profile_counters.json'
+
+class Profiler:
+    INTERVAL: Final[float] = 0.005
+    MAX_DEPTH: Final[int] = 64
+
+    def __init__(self, kb: Keyboard) -> None:
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.thread: threading.Thread | None = None
+        self.stop_event = threading.Event()
+
+        kb.bind('F10', keyboard.State(), self.toggle)
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def toggle(self) -> None:
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        COUNTERS.clear()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.sample_loop, name='profiler', daemon=True)
+        self.thread.start()
+        print('Profiler started')
+
+    def stop(self) -> None:
+        if not self.thread:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.write()
+        print(f'Profiler stopped: {self.samples} samples -> {PROFILE_STACKS}')
+
+    def collapse(self, frame: FrameType | None) -> str:
+        names: list[str] = []
+        while frame and len(names) < self.MAX_DEPTH:
+            code = frame.f_code
+            names.append(f'{Path(code.co_filename).name}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample_loop(self) -> None:
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.INTERVAL):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                self.stacks[f'{name};{self.collapse(frame)}'] += 1
+            self.samples += 1
+
+    def write(self) -> None:
+        with open(PROFILE_STACKS, 'w', encoding='utf8') as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write(f'{stack} {count}\n')
+        with open(PROFILE_COUNTERS, 'w', encoding='utf8') as fp:
+            json.dump(dict(COUNTERS), fp, indent=2)
@@ -0,0 +1,117 @@
+import queue
+import re
+import threading
+
+from collections import deque
+from dataclasses import dataclass
+from time import perf_counter
+from typing import TYPE_CHECKING, Final
+
+import keyboard
+import tasks
+from screen import MESSAGE_ROW, MORE, YN
+from stats import COUNTERS
+
+if TYPE_CHECKING:
+    from nethack import NetHack
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    pattern: re.Pattern[str]
+    # Screen mode the rule applies to, None for any
+    kind: str | None = None
+    answer: str = ''
+    # The scripted action can't go on, checks give up right away instead of timing out
+    stall: bool = False
+
+@dataclass(frozen=True)
+class Handled:
+    rule: str
+    row: int
+    text: str
+    time: float
+
+# Tried in order, the first matching rule with an answer wins a row.
+# Stall rules only count, the --More-- that often follows them still gets dismissed.
+RULES: Final[tuple[Rule, ...]] = (
+    Rule('boulder_stuck', re.compile(r'You try to move the boulder,? but in vain'), stall=True),
+    Rule('boulder_blocked', re.compile(r'Perhaps that\'s why you cannot move past it'), stall=True),
+    Rule('really_attack', re.compile(r'Really attack .*\?'), YN, 'n'),
+    # Space shows the next message, escape would skip all of them
+    Rule('more', re.compile(r'--More--'), MORE, ' '),
+)
+
+class Responder:
+    # Answers known prompts as soon as the classifier sees them, from the parser thread,
+    # but only while an automation task runs: a human at the keyboard reads their own prompts.
+    # Keys go out from a thread of its own so parsing never waits on `screen -X`.
+    HISTORY: Final[int] = 32
+
+    def __init__(self, nh: 'NetHack', rules: tuple[Rule, ...] = RULES) -> None:
+        self.nh = nh
+        self.screen = nh.screen
+        self.rules = rules
+        self.enabled = True
+        self.frames = 0
+        # Row texts already handled and the frame their answer went out at, None while it is queued
+        # (or for rules without an answer). A prompt still on screen after that frame is a new one.
+        self.answered: dict[tuple[str, int], tuple[str, int | None]] = {}
+        self.history: deque[Handled] = deque(maxlen=self.HISTORY)
+        self.stalls = 0
+        self.answers: queue.SimpleQueue[tuple[tuple[str, int], str, str]] = queue.SimpleQueue()
+
+        threading.Thread(target=self.send_loop, name='responder', daemon=True).start()
+        nh.term.listeners.append(self.update)
+        nh.keyboard.bind('F8', keyboard.State(), self.toggle)
+
+    def toggle(self) -> None:
+        self.enabled = not self.enabled
+        print(f'Responder {"enabled" if self.enabled else "disabled"}')
+
+    def update(self) -> None:
+        self.frames += 1
+        if not self.enabled or not tasks.active():
+            self.answered.clear()
+            return
+        texts = self.screen.texts
+        for key, (text, _) in list(self.answered.items()):
+            if texts.get(key[1]) != text:
+                del self.answered[key]
+
+        mode = self.screen.mode
+        for row in {MESSAGE_ROW, mode.row}:
+            if not (shown := texts.get(row)):
+                continue
+            for rule in self.rules:
+                if rule.kind is not None and rule.kind != mode.kind:
+                    continue
+                if not rule.pattern.search(shown):
+                    continue
+                if self.fresh((rule.name, row), shown):
+                    self.answered[(rule.name, row)] = (shown, None)
+                    self.handle(rule, row, shown)
+                if rule.answer:
+                    break
+
+    def fresh(self, key: tuple[str, int], text: str) -> bool:
+        if (answered := self.answered.get(key)) is None or answered[0] != text:
+            return True
+        sent = answered[1]
+        return sent is not None and self.frames > sent
+
+    def handle(self, rule: Rule, row: int, text: str) -> None:
+        COUNTERS[f'responder_{rule.name}'] += 1
+        self.history.append(Handled(rule.name, row, text.strip(), perf_counter()))
+        if rule.stall:
+            self.stalls += 1
+        if rule.answer:
+            self.answers.put(((rule.name, row), text, rule.answer))
+        print(f'Responder: {rule.name} "{text.strip()}" -> {rule.answer!r}')
+
+    def send_loop(self) -> None:
+        while True:
+            key, text, answer = self.answers.get()
+            self.nh.press(answer)
+            if self.answered.get(key, ('', None))[0] == text:
+                self.answered[key] = (text, self.frames)
@@ -0,0 +1,130 @@
+import re
+import threading
+
+from dataclasses import dataclass
+from typing import Callable, Final
+
+import tasks
+from stats import COUNTERS
+from term import Term, DEC_CHARSET, CLEAR, ROW
+
+# Screen modes, most specific first: a prompt may sit on top of a menu
+YN: Final[str] = 'yn'
+MORE: Final[str] = 'more'
+MENU: Final[str] = 'menu'
+TEXT: Final[str] = 'text'
+MAP: Final[str] = 'map'
+
+MESSAGE_ROW: Final[int] = 1
+
+MORE_RE: Final[re.Pattern[str]] = re.compile(r'--More--')
+PAGE_RE: Final[re.Pattern[str]] = re.compile(r'\(Page (\d+) of (\d+)\)')
+END_RE: Final[re.Pattern[str]] = re.compile(r'\(end\)')
+# [yn], [ynq], [ynaq], [yn#q]: item prompts like [abc or ?*] are not yes/no questions
+YN_RE: Final[re.Pattern[str]] = re.compile(r'^\s*(.*?)\s*\[(yn[aq#]*)\](?: \((\S)\))?\s*$')
+
+WALLS: Final[frozenset[str]] = frozenset(DEC_CHARSET[code] for code in range(0x6a, 0x79))
+
+@dataclass(frozen=True)
+class Mode:
+    kind: str = MAP
+    row: int = 0
+    # MENU: current page and page count, single page menus and text windows are 1 of 1
+    page: int = 0
+    pages: int = 0
+    # YN: the question, accepted answers and the default answer
+    prompt: str = ''
+    choices: str = ''
+    default: str = ''
+
+class Classifier:
+    # Keeps per-row features up to date from the change bus, so telling the
+    # screen mode apart never needs a full screen scan
+    def __init__(self, term: Term, map_rows: range | None = None) -> None:
+        self.term = term
+        # Only overlays on the map count as covering it, the status lines never do
+        self.map_rows = map_rows if map_rows is not None else range(term.height)
+        self.changes = term.subscribe([CLEAR, ROW])
+        self.texts: dict[int, str] = {}
+        self.more: set[int] = set()
+        self.pages: dict[int, tuple[int, int]] = {}
+        self.ends: set[int] = set()
+        self.covered_rows: set[int] = set()
+        self.prompt: Mode | None = None
+        self.mode = Mode()
+        self.generation = 0
+        self.condition = threading.Condition()
+        term.listeners.append(self.update)
+
+    @property
+    def covered(self) -> bool:
+        # The menu overlay shows walls in magenta
+        return bool(self.covered_rows)
+
+    def clear(self) -> None:
+        self.texts.clear()
+        self.more.clear()
+        self.pages.clear()
+        self.ends.clear()
+        self.covered_rows.clear()
+        self.prompt = None
+
+    def classify_row(self, y: int, text: str) -> None:
+        COUNTERS['classified_rows'] += 1
+        self.texts[y] = text
+        self.more.discard(y)
+        self.pages.pop(y, None)
+        self.ends.discard(y)
+        self.covered_rows.discard(y)
+
+        if MORE_RE.search(text):
+            self.more.add(y)
+        if m := PAGE_RE.search(text):
+            self.pages[y] = (int(m.group(1)), int(m.group(2)))
+        elif END_RE.search(text):
+            self.ends.add(y)
+        if y == MESSAGE_ROW:
+            self.prompt = None
+            if m := YN_RE.match(text):
+                self.prompt = Mode(YN, y, prompt=m.group(1), choices=m.group(2),
+                                   default=m.group(3) or '')
+
+        if y in self.map_rows and any(c in WALLS for c in text):
+            for x, c in enumerate(text):
+                glyph = self.term.at(x, y)
+                if c in WALLS and glyph and glyph.attr.fg_color == 5:
+                    self.covered_rows.add(y)
+                    break
+
+    def classify(self) -> Mode:
+        if self.prompt:
+            return self.prompt
+        if self.more:
+            return Mode(MORE, max(self.more))
+        if self.pages:
+            row = max(self.pages)
+            page, pages = self.pages[row]
+            return Mode(MENU, row, page, pages)
+        if self.ends:
+            return Mode(TEXT, max(self.ends), 1, 1)
+        return Mode()
+
+    def update(self) -> None:
+        if not (changes := self.changes.drain()):
+            return
+        for change in changes:
+            if change.kind == CLEAR:
+                self.clear()
+            else:
+                self.classify_row(change.row, change.text)
+        mode = self.classify()
+        with self.condition:
+            self.mode = mode
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, predicate: Callable[[Mode], bool], timeout: float | None = None) -> Mode | None:
+        with self.condition:
+            if tasks.wait(self.condition, lambda: predicate(self.mode), timeout):
+                return self.mode
+            return None
@@ -0,0 +1,161 @@
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+
+from pathlib import Path
+from typing import Any, Callable, Final
+
+from stats import COUNTERS
+from term import Term, CLEAR, ROW, CURSOR, Change
+
+SCREEN_SOCKET: Final[Path] = Path(__file__).parents[1] / 'tmp/screen.sock'
+
+Message = dict[str, Any]
+
+# ASCII without NUL, control keys included: what the game takes as keystrokes
+KEYS_RE: Final[re.Pattern[str]] = re.compile(r'[\x01-\x7f]{1,256}')
+
+def change_message(change: Change) -> Message:
+    message: Message = {'kind': change.kind}
+    if change.kind == ROW:
+        message['row'] = change.row
+        message['text'] = change.text.rstrip()
+    if change.cursor:
+        message['cursor'] = [change.cursor.x, change.cursor.y]
+    return message
+
+class Handler(socketserver.StreamRequestHandler):
+    # One JSON object per line each way:
+    #   {"cmd": "frame", "attrs": false} -> rows, cursor, maxy
+    #   {"cmd": "cursor"}                -> cursor
+    #   {"cmd": "status"}                -> whatever the status callback reports
+    #   {"cmd": "subscribe", "kinds": [...], "rows": [...]} -> frame, then changes until closed
+    #   {"cmd": "keys", "keys": "..."}   -> sent through the bot's input path
+    server: 'ScreenServer'
+
+    def send(self, message: Message) -> None:
+        self.wfile.write(json.dumps(message, separators=(',', ':')).encode() + b'\n')
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                cmd = request.get('cmd')
+            except (ValueError, AttributeError):
+                self.send({'error': 'expected a JSON object per line'})
+                continue
+            COUNTERS[f'server_{cmd}'] += 1
+            try:
+                match cmd:
+                    case 'frame':
+                        self.send(self.server.frame(request.get('attrs', False)))
+                    case 'cursor':
+                        self.send({'cursor': self.server.cursor()})
+                    case 'status':
+                        self.send(self.server.status())
+                    case 'keys':
+                        if not KEYS_RE.fullmatch(keys := str(request['keys'])):
+                            self.send({'error': 'keys must be 1-256 ASCII chars'})
+                            continue
+                        self.server.press(keys)
+                        self.send({'ok': True})
+                    case 'subscribe':
+                        self.subscribe(request.get('kinds', [CLEAR, ROW, CURSOR]),
+                                       request.get('rows'))
+                        return
+                    case _:
+                        self.send({'error': f'unknown cmd {cmd!r}'})
+            except BrokenPipeError:
+                return
+            except KeyError as e:
+                self.send({'error': f'missing {e}'})
+
+    def subscribe(self, kinds: list[str], rows: list[int] | None) -> None:
+        term = self.server.term
+        changes = term.subscribe(kinds, rows)
+        try:
+            # Subscribed before the snapshot, so no change falls between the two
+            self.send(self.server.frame(False))
+            while not self.server.stopped.is_set():
+                if change := changes.get(1.0):
+                    self.send(change_message(change))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            term.unsubscribe(changes)
+
+class ScreenServer(socketserver.ThreadingUnixStreamServer):
+    # Serves the already parsed screen to local tools, one parser for everyone
+    daemon_threads = True
+
+    def __init__(self, term: Term, press: Callable[[str], None],
+                 status: Callable[[], Message] | None = None, path: Path = SCREEN_SOCKET) -> None:
+        self.term = term
+        self.press = press
+        self.status = status or (lambda: {})
+        self.path = path
+        self.stopped = threading.Event()
+        if path.exists():
+            path.unlink()
+        super().__init__(str(path), Handler)
+
+    def server_bind(self) -> None:
+        # Created owner-only, a chmod after bind would leave a window for other users
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def cursor(self) -> list[int]:
+        return [self.term.cursor.x, self.term.cursor.y]
+
+    def frame(self, attrs: bool) -> Message:
+        rows = range(self.term.maxy + 1)
+        frame: Message = {
+            'cursor': self.cursor(),
+            'maxy': self.term.maxy,
+            'rows': [self.term.line(y).rstrip() for y in rows],
+        }
+        if attrs:
+            frame['attrs'] = [[glyph.attr.pack() if (glyph := self.term.at(x, y)) else 0
+                               for x in range(self.term.width)] for y in rows]
+        return frame
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name='server', daemon=True).start()
+        print(f'Screen server on {self.path}')
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+        self.path.unlink(missing_ok=True)
+
+def client() -> None:
+    # python server.py frame | cursor | status | watch | keys <keys>
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'frame'
+    request: Message = {'cmd': 'subscribe' if cmd == 'watch' else cmd}
+    if cmd == 'keys':
+        request['keys'] = sys.argv[2]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(SCREEN_SOCKET))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('r', encoding='utf8') as fp:
+            for line in fp:
+                message = json.loads(line)
+                if 'rows' in message:
+                    print('\n'.join(row.rstrip() for row in message['rows']))
+                else:
+                    print(message)
+                if cmd != 'watch':
+                    break
+
+if __name__ == '__main__':
+    client()
@@ -0,0 +1,189 @@
+import logging
+import multiprocessing
+import operator
+import threading
+
+from array import array
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from time import sleep
+from typing import Final
+
+from point import Point
+from stats import COUNTERS
+from term import Term, Glyph, Attr, DEFAULT_GEOMETRY
+
+# Header of u64 words, followed by the grid of (codepoint, attr) u32 pairs, row by row.
+# Codepoint 0 marks a cell that was never written.
+SEQ, GENERATION, CURSOR_X, CURSOR_Y, MAXY, SHOW_CURSOR, CLEARS = range(7)
+HEADER_WORDS: Final[int] = 8
+HEADER_BYTES: Final[int] = HEADER_WORDS * 8
+
+def unpack(char: int, attr: int) -> Glyph | None:
+    return Glyph(chr(char), Attr.unpack(attr)) if char else None
+
+class Publisher:
+    # Runs in the parser process, copies changed rows on every frame
+    def __init__(self, term: Term, buf: memoryview, conn: Connection) -> None:
+        self.term = term
+        self.header = buf[:HEADER_BYTES].cast('Q')
+        self.cells = buf[HEADER_BYTES:].cast('I')
+        self.conn = conn
+        # Rows are compared by glyph identity: the parser never mutates a written glyph
+        self.rows: list[list[Glyph | None] | None] = [None] * term.capacity[1]
+        self.maxy = 0
+
+    def encode(self, row: list[Glyph | None]) -> 'array[int]':
+        cells = array('I', bytes(8 * len(row)))
+        for x, glyph in enumerate(row):
+            if glyph:
+                cells[2 * x] = ord(glyph.char)
+                cells[2 * x + 1] = glyph.attr.pack()
+        return cells
+
+    def publish(self) -> None:
+        term = self.term
+        header = self.header
+        span = 2 * term.capacity[0]
+        # Odd sequence while writing, readers retry until it is even and unchanged
+        header[SEQ] += 1
+        for y in range(max(term.maxy, self.maxy) + 1):
+            row = term.glyphs[y]
+            cached = self.rows[y]
+            if cached is not None and all(map(operator.is_, row, cached)):
+                continue
+            self.cells[y * span:(y + 1) * span] = self.encode(row)
+            self.rows[y] = row[:]
+            COUNTERS['shm_rows'] += 1
+        header[CURSOR_X] = term.cursor.x
+        header[CURSOR_Y] = term.cursor.y
+        header[MAXY] = term.maxy
+        header[SHOW_CURSOR] = term.show_cursor
+        header[CLEARS] = term.clears
+        header[GENERATION] += 1
+        header[SEQ] += 1
+        self.maxy = term.maxy
+        self.conn.send(header[GENERATION])
+
+def serve(buf: memoryview, conn: Connection, logger: logging.Logger, fifo: bool) -> None:
+    # The shared grid is laid out once, the parser must not fit it to the terminal
+    term = Term(logger, fifo, DEFAULT_GEOMETRY)
+    term.listeners.append(Publisher(term, buf, conn).publish)
+    term.start()
+
+class SharedTerm(Term):
+    # Parses in a child process, the bot reads glyphs straight from shared memory.
+    # The pipe only wakes the reader, frames themselves never cross it.
+    def __init__(self, logger: logging.Logger = logging.getLogger(), fifo: bool = True) -> None:
+        super().__init__(logger, fifo)
+        self.shm = SharedMemory(create=True,
+                                size=HEADER_BYTES + 8 * self.capacity[0] * self.capacity[1])
+        self.header = self.shm.buf[:HEADER_BYTES].cast('Q')
+        self.cells = self.shm.buf[HEADER_BYTES:].cast('I')
+        self.generation = 0
+
+        recv, send = multiprocessing.Pipe(duplex=False)
+        self.conn = recv
+        # Forked before any other thread exists, the child inherits the mapping
+        self.process = multiprocessing.get_context('fork').Process(
+            target=serve, args=(self.shm.buf, send, logger, fifo), name='term', daemon=True)
+        self.process.start()
+        send.close()
+
+    def reset(self) -> None:
+        self.cursor = Point(1, 1)
+        self.maxy = 0
+        self.show_cursor = True
+
+    def snapshot(self) -> list[list[Glyph | None]]:
+        # The grid lives in the child, decoded from one consistent read
+        while True:
+            seq = self.read_seq()
+            cells = self.cells.tolist()
+            if self.header[SEQ] == seq:
+                break
+            COUNTERS['shm_retries'] += 1
+        span = 2 * self.capacity[0]
+        return [[unpack(cells[i], cells[i + 1]) for i in range(y * span, (y + 1) * span, 2)]
+                for y in range(self.capacity[1])]
+
+    def read_seq(self) -> int:
+        while (seq := self.header[SEQ]) & 1:
+            COUNTERS['shm_retries'] += 1
+        return seq
+
+    def __getitem__(self, at: Point) -> None | Glyph:
+        idx = 2 * (at.y * self.capacity[0] + at.x)
+        while True:
+            seq = self.read_seq()
+            char, attr = self.cells[idx], self.cells[idx + 1]
+            if self.header[SEQ] == seq:
+                return unpack(char, attr)
+            COUNTERS['shm_retries'] += 1
+
+    def line(self, y: int) -> str:
+        span = 2 * self.capacity[0]
+        while True:
+            seq = self.read_seq()
+            chars = self.cells[y * span:(y + 1) * span:2].tolist()
+            if self.header[SEQ] == seq:
+                return ''.join(chr(c) if c else ' ' for c in chars)
+            COUNTERS['shm_retries'] += 1
+
+    def row_attrs(self, y: int) -> list[int]:
+        span = 2 * self.capacity[0]
+        while True:
+            seq = self.read_seq()
+            attrs = self.cells[y * span + 1:(y + 1) * span:2].tolist()
+            if self.header[SEQ] == seq:
+                return attrs
+            COUNTERS['shm_retries'] += 1
+
+    def read_header(self) -> None:
+        while True:
+            seq = self.read_seq()
+            cursor = Point(self.header[CURSOR_X], self.header[CURSOR_Y])
+            maxy, show_cursor = self.header[MAXY], bool(self.header[SHOW_CURSOR])
+            generation, clears = self.header[GENERATION], self.header[CLEARS]
+            if self.header[SEQ] == seq:
+                break
+        self.cursor, self.maxy, self.show_cursor = cursor, maxy, show_cursor
+        self.generation = generation
+        if clears != self.clears:
+            self.clears = clears
+            self.cleared = True
+        # Which rows changed is not shared, the bus compares texts to find out
+        self.dirty.update(range(maxy + 1))
+
+    def do_yield(self) -> None:
+        COUNTERS['yields'] += 1
+        sleep(0.001)
+
+    def start(self) -> None:
+        while True:
+            try:
+                self.conn.recv()
+                # Frames published while we were busy collapse into one wakeup
+                while self.conn.poll():
+                    self.conn.recv()
+            except EOFError:
+                break
+            self.read_header()
+            self.frame()
+
+    def close(self) -> None:
+        self.process.terminate()
+        self.header.release()
+        self.cells.release()
+        self.shm.close()
+        self.shm.unlink()
+
+def test() -> None:
+    term = SharedTerm(fifo=False)
+    thread = threading.Thread(target=term.start, daemon=True)
+    thread.start()
+    term.process.join()
+    thread.join()
+    for line in term.lines():
+        print(line.rstrip())
+    term.close()
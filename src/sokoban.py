@@ -1,20 +1,71 @@
+import copy
+import json
 import logging
+import re
 import string
 import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field, asdict
+from typing import Final, Iterator, TypeAlias
 
+import solver
+import tasks
 from keyboard import Keyboard
-from nethack import NetHack
+from nethack import NetHack, Pipeline
 from term import Term
 from point import Point
+from stats import STATS
+
+SOLUTIONS_DIR: Final[Path] = Path(__file__).parents[1] / 'res' / 'sokoban'
+SOLUTIONS_INDEX: Final[Path] = Path(__file__).parents[1] / 'tmp' / 'sokoban_index.json'
+SOKOBAN: Final[str] = 'sokoban'
+# solution_2b.txt is the second level from the bottom, variant b
+SOLUTION_NAME: Final[re.Pattern[str]] = re.compile(r'solution_(\d+)([a-z])\.txt')
+
+REPLAN_BUDGET: Final[float] = 10.0
+REPLAN_ATTEMPTS: Final[int] = 3
+
+# Walks longer than this go through travel instead of direct movement keys
+HOP_LIMIT: Final[int] = 12
+# Bursts sent ahead of the screen before waiting for verification
+PIPELINE_WINDOW: Final[int] = 4
+
+# Walls, boulders and stairs by their offset from the player
+Layout: TypeAlias = dict[Point, str]
+# Fewer matching cells than this could fit more than one level
+MIN_VISIBLE: Final[int] = 24
 
 @dataclass
 class Solution:
     sl_map: list[list[str]]
     sl_steps: list[str]
 
+@dataclass
+class Burst:
+    # Keys sent in one go, verified once at the end
+    keys: str = ''
+    travel: Point | None = None
+    player: Point = field(default_factory=Point)
+    boulder: Point | None = None
+    fills: bool = False
+
+@dataclass
+class Prepared:
+    # A candidate for the next level, compiled before we get there
+    name: str
+    solutions: list[Solution]
+    plan: list[Burst]
+
+@dataclass
+class IndexEntry:
+    mtime: float
+    # Layout cells as [dx, dy, kind], JSON has no tuple keys
+    layout: list[tuple[int, int, str]]
+    solutions: list[Solution]
+
 def read_solution(file_name: Path) -> list[Solution]:
     with open(file_name, 'r') as fp:
         s = fp.read().splitlines()
@@ -62,96 +113,409 @@ def match_map(solution: list[Solution], nh: NetHack) -> Point | None:
             point = Point(x, y) + start
             if cell == '#':
                 if not nh.is_wall(point):
-                    print(start, x, y, nh.at(point), cell)
                     return None
             elif cell == '<':
                 if nh.at(point) != nh.STAIRS:
-                    print(start, x, y, nh.at(point), cell)
                     return None
             elif cell in string.ascii_uppercase:
                 if nh.at(point) != nh.BOULDER:
-                    print(start, x, y, nh.at(point), cell)
                     return None
 
     return start
 
+def solution_start(solution: list[Solution]) -> Point:
+    return next(Point(x, y) for y, row in enumerate(solution[0].sl_map)
+                for x, cell in enumerate(row) if cell == '@')
 
-def run_solution(solutions: list[Solution], nh: NetHack, start: Point) -> None:
+def solution_layout(solution: list[Solution]) -> Layout:
+    start = solution_start(solution)
+    layout = {}
+    for y, row in enumerate(solution[0].sl_map):
+        for x, cell in enumerate(row):
+            if cell in '#<':
+                layout[Point(x, y) - start] = cell
+            elif cell in string.ascii_uppercase:
+                layout[Point(x, y) - start] = '0'
+    return layout
+
+def screen_layout(nh: NetHack) -> Layout:
+    # What is visible right now: on arrival that's the player's surroundings, not the level
+    layout = {}
+    for y in range(nh.HEIGHT):
+        for x in range(nh.WIDTH):
+            point = Point(x, y)
+            if nh.is_wall(point):
+                layout[point - nh.pos] = '#'
+            elif nh.at(point) == nh.STAIRS:
+                layout[point - nh.pos] = '<'
+            elif nh.at(point) == nh.BOULDER:
+                layout[point - nh.pos] = '0'
+    return layout
+
+def fits(layout: Layout, seen: Layout) -> bool:
+    # Everything seen must be where the solution has it, unseen cells don't count
+    return len(seen) >= MIN_VISIBLE and all(layout.get(p) == kind for p, kind in seen.items())
+
+class SolutionIndex:
+    def __init__(self, path: Path = SOLUTIONS_INDEX) -> None:
+        self.path = path
+        self.entries: dict[str, IndexEntry] = {}
+        self.layouts: dict[str, Layout] = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf8') as fp:
+                raw = json.load(fp)
+        except (OSError, ValueError):
+            return
+        try:
+            for name, entry in raw.items():
+                self.entries[name] = IndexEntry(
+                    entry['mtime'],
+                    [tuple(cell) for cell in entry['layout']],
+                    [Solution(**solution) for solution in entry['solutions']],
+                )
+        except (KeyError, TypeError):
+            # Written by an older version, refresh() rebuilds it
+            self.entries.clear()
+
+    def save(self) -> None:
+        with open(self.path, 'w', encoding='utf8') as fp:
+            json.dump({name: asdict(entry) for name, entry in self.entries.items()}, fp)
+
+    def refresh(self) -> None:
+        changed = False
+        files = {file.name: file for file in SOLUTIONS_DIR.glob('solution_*.txt')}
+        for name in set(self.entries) - set(files):
+            del self.entries[name]
+            changed = True
+        for name, file in files.items():
+            mtime = file.stat().st_mtime
+            if name in self.entries and self.entries[name].mtime == mtime:
+                continue
+            solution = read_solution(file)
+            layout = [(p.x, p.y, kind) for p, kind in solution_layout(solution).items()]
+            self.entries[name] = IndexEntry(mtime, layout, solution)
+            changed = True
+
+        if changed or not self.layouts:
+            self.layouts = {
+                name: {Point(x, y): kind for x, y, kind in entry.layout}
+                for name, entry in self.entries.items()
+            }
+        if changed:
+            try:
+                self.save()
+            except OSError as e:
+                print(f'Failed to save solution index: {e}')
+
+    def solution(self, name: str) -> list[Solution]:
+        # Callers may update the maps in place, never hand out the cached copy
+        return copy.deepcopy(self.entries[name].solutions)
+
+    def match(self, nh: NetHack, names: list[str] | None = None) -> str | None:
+        # Only a single level fitting what is on screen counts
+        seen = screen_layout(nh)
+        fitting = [name for name in (self.layouts if names is None else names)
+                   if fits(self.layouts[name], seen)]
+        return fitting[0] if len(fitting) == 1 else None
+
+    def identify(self, nh: NetHack) -> str | None:
+        # Layouts only, cheap enough to run on every level change
+        self.refresh()
+        return self.match(nh)
+
+    def level(self, level: int) -> list[str]:
+        return sorted(name for name in self.entries
+                      if (m := SOLUTION_NAME.fullmatch(name)) and int(m.group(1)) == level)
+
+    def find(self, nh: NetHack) -> tuple[str, list[Solution], Point] | None:
+        self.refresh()
+        if name := self.match(nh):
+            solution = self.solution(name)
+            return name, solution, nh.pos - solution_start(solution)
+
+        # Too little in sight to tell, or the boulders moved: compare map by map
+        for name in sorted(self.entries):
+            solution = self.solution(name)
+            if start := match_map(solution, nh):
+                return name, solution, start
+        return None
+
+INDEX: SolutionIndex | None = None
+INDEX_LOCK: Final[threading.Lock] = threading.Lock()
+
+def solution_index() -> SolutionIndex:
+    global INDEX # pylint: disable=global-statement
+    # Callers wait here while preload() is still reading the solutions
+    with INDEX_LOCK:
+        if INDEX is None:
+            INDEX = SolutionIndex()
+            INDEX.refresh()
+    return INDEX
+
+def preload() -> None:
+    threading.Thread(target=solution_index, name='sokoban-index', daemon=True).start()
+
+
+def plan_solution(board: solver.Board, pushes: list[solver.Push]) -> Solution:
+    # Name boulders like the canned solutions do, so compile_solution can replay the plan
+    sl_map = board.sl_map()
+    names = iter(string.ascii_uppercase + string.ascii_lowercase)
+    where: dict[Point, str] = {}
+    for idx in sorted(board.boulders):
+        p = board.point(idx)
+        where[p] = sl_map[p.y][p.x] = next(names)
+
+    sl_steps: list[str] = []
+    for push in pushes:
+        char = where.pop(push.boulder)
+        move = push.direction + ('*' if push.fills else '')
+        if sl_steps and sl_steps[-1][0] == char and sl_steps[-1][-1] != '*':
+            sl_steps[-1] += move
+        else:
+            sl_steps.append(f'{char} {move}')
+        if not push.fills:
+            where[push.boulder + solver.PUSHES[push.direction]] = char
+
+    return Solution(sl_map, sl_steps)
+
+def replan(nh: NetHack, budget: float = REPLAN_BUDGET) -> bool:
+    nh.term.do_yield()
+    nh.read_pos()
+    board = solver.Board.from_screen(nh)
+    if not board.holes:
+        return True
+
+    print(f'Re-planning: {len(board.boulders)} boulders, {len(board.holes)} holes')
+    engine = solver.Solver(board, budget)
+    if (pushes := engine.solve()) is None:
+        print(f"Sorry, I couldn't find a plan in {budget}s ({engine.expanded} states)")
+        return False
+
+    print(f'Plan: {len(pushes)} pushes ({engine.expanded} states)')
+    return run_plan(compile_solution([plan_solution(board, pushes)], nh.pos), nh, Point())
+
+def walk(sl_map: list[list[str]], src: Point, dst: Point) -> list[Point] | None:
+    def free(p: Point) -> bool:
+        if not (0 <= p.y < len(sl_map) and 0 <= p.x < len(sl_map[p.y])):
+            return False
+        return sl_map[p.y][p.x] not in ' #^' and not sl_map[p.y][p.x].isalpha()
+
+    def rock(p: Point) -> bool:
+        return not (0 <= p.y < len(sl_map) and 0 <= p.x < len(sl_map[p.y])) \
+            or sl_map[p.y][p.x] in ' #' or sl_map[p.y][p.x].isalpha()
+
+    prev: dict[Point, Point | None] = {src: None}
+    queue = [src]
+    for cur in queue:
+        if cur == dst:
+            break
+        for (_, d) in NetHack.DIRECTIONS.values():
+            nxt = cur + d
+            if nxt in prev or not free(nxt):
+                continue
+            if d.x and d.y:
+                # Sokoban forbids squeezing diagonally, doorways forbid diagonals at all
+                if rock(cur + Point(d.x, 0)) and rock(cur + Point(0, d.y)):
+                    continue
+                if '+' in (sl_map[cur.y][cur.x], sl_map[nxt.y][nxt.x]):
+                    continue
+            prev[nxt] = cur
+            queue.append(nxt)
+
+    if dst not in prev:
+        return None
+    path = []
+    node: Point | None = dst
+    while node is not None and node != src:
+        path.append(node)
+        node = prev[node]
+    path.reverse()
+    return path
+
+def compile_solution(solutions: list[Solution], player: Point) -> list[Burst]:
     # pylint: disable=too-many-locals
+    keys = {d: key for (key, d) in NetHack.DIRECTIONS.values()}
+    plan: list[Burst] = []
+    burst = Burst()
+
+    def close(boulder: Point | None, fills: bool = False) -> None:
+        nonlocal burst
+        if burst.keys or burst.travel:
+            burst.player = player
+            burst.boulder = boulder
+            burst.fills = fills
+            plan.append(burst)
+        burst = Burst()
 
     for solution in solutions:
-        sl_map = solution.sl_map
-        print('>>>>>>>>>>>>>>>>>>>>>>>>>')
-        print(solution.sl_steps)
+        sl_map = copy.deepcopy(solution.sl_map)
+        for row in sl_map:
+            for x, cell in enumerate(row):
+                if cell == '@':
+                    row[x] = '.'
+
         for boulder in solution.sl_steps:
             char = boulder[0]
             moves = boulder[2:]
-
-            b_pos: Point | None = None
-
-            for y, row in enumerate(sl_map):
-                for x, cell in enumerate(row):
-                    if cell == char:
-                        b_pos = Point(x, y)
-                        break
-
-            if not b_pos:
-                raise ValueError(f"Can't find boulder {char}")
+            b_pos = next(Point(x, y) for y, row in enumerate(sl_map)
+                         for x, cell in enumerate(row) if cell == char)
 
             for i, move in enumerate(moves):
-                if move == ' ':
+                if move in ' *':
                     continue
-
-                dr = nh.DIRECTIONS[move]
-                to = b_pos + dr[1] * (-1)
-
-                print(f'boulder={char} nh.pos={nh.pos} start={start}')
-                print(f'to={to}, b_pos={b_pos}', dr)
-                for s in sl_map:
-                    print(''.join(s))
-
-                if not nh.go_to(to + start):
-                    break # boulder is finished manually or destroyed
-                nh.press(nh.DIRECTIONS[move][0])
-                nh.pos += nh.DIRECTIONS[move][1]
+                d = NetHack.DIRECTIONS[move][1]
+                behind = b_pos - d
+                path = walk(sl_map, player, behind)
+                if path is None or len(path) > HOP_LIMIT:
+                    close(b_pos)
+                    burst.travel = behind
+                else:
+                    burst.keys += ''.join(keys[step - prev] for prev, step
+                                          in zip([player] + path, path))
+                burst.keys += NetHack.DIRECTIONS[move][0]
+                player = b_pos
                 sl_map[b_pos.y][b_pos.x] = '.'
-                b_pos += nh.DIRECTIONS[move][1]
-                sl_map[b_pos.y][b_pos.x] = char
-                if not nh.check("Boulder didn't move?"):
-                    break # boulder is finished manually or destroyed
+                b_pos += d
 
-                if (i + 1) < len(moves) and moves[i + 1] == '*':
-                    nh.check("Boulder didn't fill the hole?", b_pos + start, nh.EMPTY)
+                # A hole swallows the boulder even where the steps expect it to roll on
+                filled = (i + 1) < len(moves) and moves[i + 1] == '*'
+                if filled or sl_map[b_pos.y][b_pos.x] == '^':
                     sl_map[b_pos.y][b_pos.x] = '.'
+                    close(b_pos, fills=True)
                     break
-                if not nh.check("Boulder didn't move?", b_pos + start, nh.BOULDER):
-                    break # boulder is finished manually or destroyed
+                sl_map[b_pos.y][b_pos.x] = char
+            else:
+                close(b_pos)
+
+    return plan
+
+def run_plan(plan: list[Burst], nh: NetHack, start: Point) -> bool:
+    # Each burst ends in a push, its latency runs until the pushed boulder shows
+    with Pipeline(nh, PIPELINE_WINDOW, metric='push') as pipeline:
+        for i, burst in enumerate(plan):
+            print(f'burst={burst}')
+            tasks.report(i, len(plan), 'bursts')
+            with STATS.time('burst'):
+                if burst.travel:
+                    # Travel reads the screen, everything in flight has to land first
+                    if not pipeline.drain() or not nh.go_to(burst.travel + start):
+                        return False # travel failed, blocked or interrupted
+                checks = []
+                if burst.boulder:
+                    expected = nh.EMPTY if burst.fills else nh.BOULDER
+                    checks.append((burst.boulder + start, expected))
+                if not pipeline.send(burst.keys, burst.player + start, checks):
+                    return False
+        if not pipeline.drain():
+            return False
+    return nh.check("Plan went astray?")
+
+def find_cell(solutions: list[Solution], char: str) -> Point | None:
+    for y, row in enumerate(solutions[0].sl_map):
+        for x, cell in enumerate(row):
+            if cell == char:
+                return Point(x, y)
+    return None
+
+def prepare(names: list[str]) -> list[Prepared]:
+    prepared = []
+    for name in names:
+        solutions = solution_index().solution(name)
+        if player := find_cell(solutions, '@'):
+            prepared.append(Prepared(name, solutions, compile_solution(solutions, player)))
+    return prepared
+
+@contextmanager
+def options(nh: NetHack) -> Iterator[None]:
+    nh.set_option('runmode', 't')
+    nh.set_option('pile_limit', '2\n')
+    try:
+        yield
+    finally:
+        # Runs after an abort as well, the options must not stay changed
+        with tasks.shielded():
+            nh.set_option('runmode', 'w')
+            nh.set_option('pile_limit', '0\n')
 
+def finish(nh: NetHack, plan: list[Burst] | None, start: Point) -> bool:
+    done = plan is not None and run_plan(plan, nh, start)
+    for _ in range(REPLAN_ATTEMPTS):
+        if done:
+            break
+        tasks.report(0, 0, 'replanning')
+        done = replan(nh)
+    return done
 
 def solve(nh: NetHack) -> None:
     nh.term.do_yield()
     nh.read_pos()
     print(nh.symbol)
 
-    solutions = (Path(__file__).parents[1] / 'res' / 'sokoban').glob("solution_*.txt")
-    good = False
-    for file in solutions:
-        print(f'Checking solution: {file}')
-        solution = read_solution(file)
-        if start := match_map(solution, nh):
-            print("Start:", start)
-            nh.set_option('runmode', 't')
-            nh.set_option('pile_limit', '2\n')
-
-            run_solution(solution, nh, start)
-            good = True
-
-            nh.set_option('runmode', 'w')
-            nh.set_option('pile_limit', '0\n')
-            break
+    found = solution_index().find(nh)
+    if not found:
+        print("Sorry, I couldn't match any solutions")
+        # The solver takes every boulder and trap for a puzzle, keep it out of the main dungeon
+        if nh.branch != SOKOBAN:
+            return
+
+    with options(nh):
+        plan = None
+        if found:
+            name, solution, start = found
+            print(f'Solution: {name}', "Start:", start)
+            plan = compile_solution(solution, nh.pos - start)
+        finish(nh, plan, start if found else Point())
+
+def solve_branch(nh: NetHack) -> None:
+    # Solves this level and every one above it up to the prize level, plans for the next
+    # level compile in the background while the boulders of this one are being pushed
+    nh.term.do_yield()
+    nh.read_pos()
 
-    if not good:
+    index = solution_index()
+    if not (found := index.find(nh)) or not (m := SOLUTION_NAME.fullmatch(found[0])):
         print("Sorry, I couldn't match any solutions")
+        return
+    name, solutions, start = found
+    current = Prepared(name, solutions, compile_solution(solutions, nh.pos - start))
+    level = int(m.group(1))
+
+    with options(nh), ThreadPoolExecutor(1, thread_name_prefix='sokoban-prepare') as pool:
+        while True:
+            upcoming = pool.submit(prepare, index.level(level + 1))
+            print(f'Solution: {current.name}', "Start:", start)
+            with STATS.time('sokoban_level'):
+                if not finish(nh, current.plan, start):
+                    print(f'Giving up on {current.name}')
+                    return
+
+            while True:
+                try:
+                    candidates = upcoming.result(tasks.Task.POLL)
+                    break
+                except TimeoutError:
+                    tasks.checkpoint()
+            stair = find_cell(current.solutions, '<')
+            if not candidates or not stair:
+                print(f'Sokoban solved up to {current.name}')
+                return
+            if not nh.climb(stair + start, '<'):
+                return
+
+            nh.term.do_yield()
+            nh.read_pos()
+            # Only the variants of the next level can be on screen
+            by_name = {candidate.name: candidate for candidate in candidates}
+            if variant := index.match(nh, list(by_name)):
+                current = by_name[variant]
+                start = nh.pos - solution_start(current.solutions)
+            else:
+                print(f"Sorry, no variant of level {level + 1} matches")
+                return
+            level += 1
 
 
 def test() -> None:
@@ -0,0 +1,350 @@
+import heapq
+import random
+
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Final, Iterable, Iterator
+
+import tasks
+from point import Point
+from nethack import NetHack
+
+# Boulders are pushed only orthogonally, the player walks in all 8 directions
+PUSHES: Final[dict[str, Point]] = {
+    name: NetHack.DIRECTIONS[name][1] for name in ['u', 'd', 'l', 'r']
+}
+WALKS: Final[list[Point]] = [d for (_, d) in NetHack.DIRECTIONS.values()]
+
+INF: Final[int] = 1 << 30
+
+@dataclass(frozen=True)
+class Push:
+    boulder: Point
+    direction: str
+    fills: bool = False
+
+@dataclass
+class Board:
+    width: int
+    height: int
+    walls: frozenset[int]
+    holes: frozenset[int]
+    boulders: frozenset[int]
+    player: int
+
+    @classmethod
+    def from_screen(cls, nh: NetHack) -> 'Board':
+        walls, holes, boulders = set(), set(), set()
+        for y in range(nh.HEIGHT):
+            for x in range(nh.WIDTH):
+                point = Point(x, y)
+                glyph = nh.at(point)
+                idx = y * nh.WIDTH + x
+                if nh.is_wall(point) or nh.is_unknown(point):
+                    walls.add(idx)
+                elif glyph == nh.BOULDER:
+                    boulders.add(idx)
+                elif glyph and glyph.char == '^':
+                    holes.add(idx)
+        return cls(nh.WIDTH, nh.HEIGHT, frozenset(walls), frozenset(holes),
+                   frozenset(boulders), nh.pos.y * nh.WIDTH + nh.pos.x)
+
+    def index(self, point: Point) -> int:
+        return point.y * self.width + point.x
+
+    def point(self, idx: int) -> Point:
+        return Point(idx % self.width, idx // self.width)
+
+    def sl_map(self) -> list[list[str]]:
+        sl_map = [['.'] * self.width for _ in range(self.height)]
+        for idx in self.walls:
+            p = self.point(idx)
+            sl_map[p.y][p.x] = '#'
+        for idx in self.holes:
+            p = self.point(idx)
+            sl_map[p.y][p.x] = '^'
+        p = self.point(self.player)
+        sl_map[p.y][p.x] = '@'
+        return sl_map
+
+class Solver:
+    # pylint: disable=too-many-instance-attributes
+    # Weighted A*: plans are replayed, not scored, so trade optimality for speed
+    WEIGHT: Final[int] = 3
+    # Expansions between checkpoints, an abort or pause lands within a few milliseconds
+    CHECKPOINT: Final[int] = 256
+    # Stands in for a boulder that can't reach a hole, keeps the assignment finite
+    UNREACHABLE: Final[int] = 1000
+
+    def __init__(self, board: Board, budget: float = 5.0) -> None:
+        self.board = board
+        self.budget = budget
+        self.deadline = 0.0
+        self.expanded = 0
+        self.estimates: dict[tuple[frozenset[int], frozenset[int]], int] = {}
+
+        w = board.width
+        # (step, side, side): diagonal steps also list the two orthogonal cells they pass
+        self.walk = [(d.y * w + d.x, d.x if d.x and d.y else 0, d.y * w if d.x and d.y else 0)
+                     for d in WALKS]
+        self.pushes = {name: d.y * w + d.x for name, d in PUSHES.items()}
+        self.blocked = [True] * (w * board.height)
+        for y in range(board.height):
+            for x in range(w):
+                idx = y * w + x
+                # Frame the board so neighbour lookups never leave it
+                edge = x in (0, w - 1) or y in (0, board.height - 1)
+                self.blocked[idx] = edge or idx in board.walls
+
+        rng = random.Random(0x50c0ba)
+        size = w * board.height
+        self.z_boulder = [rng.getrandbits(64) for _ in range(size)]
+        self.z_hole = [rng.getrandbits(64) for _ in range(size)]
+        self.z_player = [rng.getrandbits(64) for _ in range(size)]
+
+        self.distance = self.push_distances(list(board.holes))
+        self.hole_distance = {h: self.push_distances([h]) for h in board.holes}
+
+    def push_distances(self, targets: list[int]) -> list[int]:
+        # Pushes needed to bring a boulder from a cell to the nearest target.
+        # Holes count as standable here: they turn into floor once filled.
+        distance = [INF] * len(self.blocked)
+        queue = list(targets)
+        for idx in queue:
+            distance[idx] = 0
+        for target in queue:
+            for d in self.pushes.values():
+                src = target - d
+                if self.blocked[src] or self.blocked[src - d] or distance[src] != INF:
+                    continue
+                distance[src] = distance[target] + 1
+                queue.append(src)
+        return distance
+
+    def reachable(self, player: int, boulders: frozenset[int], holes: frozenset[int]) -> set[int]:
+        # 0 free, 1 wall or boulder, 2 seen, 3 hole: holes stop walking but not squeezing
+        grid = bytearray(self.blocked)
+        for b in boulders:
+            grid[b] = 1
+        for h in holes:
+            grid[h] = 3
+        grid[player] = 2
+        area = [player]
+        for cur in area:
+            for d, sx, sy in self.walk:
+                nxt = cur + d
+                if grid[nxt]:
+                    continue
+                # No squeezing diagonally between boulders and walls in Sokoban
+                if sx and grid[cur + sx] == 1 and grid[cur + sy] == 1:
+                    continue
+                grid[nxt] = 2
+                area.append(nxt)
+        return set(area)
+
+    def frozen(self, idx: int, boulders: frozenset[int], holes: frozenset[int],
+               walls: set[int]) -> bool:
+        walls.add(idx)
+        try:
+            return all(self.axis_blocked(idx, d, boulders, holes, walls)
+                       for d in (self.pushes['r'], self.pushes['d']))
+        finally:
+            walls.discard(idx)
+
+    def axis_blocked(self, idx: int, d: int, boulders: frozenset[int],
+                     holes: frozenset[int], walls: set[int]) -> bool:
+        def enter(c: int) -> bool:
+            if self.blocked[c] or c in walls:
+                return False
+            return c not in boulders or not self.frozen(c, boulders, holes, walls)
+
+        def stand(c: int) -> bool:
+            return c not in holes and enter(c)
+
+        a, b = idx - d, idx + d
+        return not ((stand(a) and enter(b)) or (stand(b) and enter(a)))
+
+    def deadlocked(self, boulders: frozenset[int], holes: frozenset[int],
+                   frozen: frozenset[int]) -> bool:
+        # Spare boulders may be wasted, only fewer usable boulders than holes is fatal.
+        # Every frozen boulder counts, however long ago it froze.
+        dead = sum(1 for b in boulders if self.distance[b] == INF or b in frozen)
+        return len(boulders) - dead < len(holes)
+
+    def freezes(self, boulders: frozenset[int], holes: frozenset[int],
+                near: Iterable[int]) -> frozenset[int]:
+        walls: set[int] = set()
+        return frozenset(b for b in near
+                         if b in boulders and self.frozen(b, boulders, holes, walls))
+
+    def refrozen(self, frozen: frozenset[int], boulders: frozenset[int], holes: frozenset[int],
+                 moved: int) -> frozenset[int]:
+        # The pushed boulder was free, so nothing was frozen against it: only the boulder
+        # and its new neighbours can have frozen with this push, and nothing thawed
+        near = [moved, *(moved + d for d, _, _ in self.walk)]
+        return frozen | self.freezes(boulders, holes, near)
+
+    def corralled(self, player: int, boulders: frozenset[int], holes: frozenset[int]) -> bool:
+        # A region the player can't get into even over filled holes, holding a hole, fenced off
+        # by walls and frozen boulders only: no boulder will ever reach that hole.
+        # 0 free or hole, 1 wall, 2 boulder, 3 seen
+        grid = bytearray(self.blocked)
+        for b in boulders:
+            grid[b] = 2
+        grid[player] = 3
+        outside = [player]
+        for cur in outside:
+            for d, _, _ in self.walk:
+                nxt = cur + d
+                if not grid[nxt]:
+                    grid[nxt] = 3
+                    outside.append(nxt)
+
+        walls: set[int] = set()
+        for start in holes:
+            if grid[start]:
+                continue
+            grid[start] = 3
+            region = [start]
+            fence: set[int] = set()
+            for cur in region:
+                for d, _, _ in self.walk:
+                    nxt = cur + d
+                    if grid[nxt] == 2:
+                        fence.add(nxt)
+                    elif not grid[nxt]:
+                        grid[nxt] = 3
+                        region.append(nxt)
+            if all(self.frozen(b, boulders, holes, walls) for b in fence):
+                return True
+        return False
+
+    def heuristic(self, boulders: frozenset[int], holes: frozenset[int]) -> int:
+        # Cheapest assignment of a boulder of its own to every hole, shared by all player positions
+        key = (boulders, holes)
+        if (cached := self.estimates.get(key)) is None:
+            cached = self.estimates[key] = self.assignment(sorted(holes), sorted(boulders))
+        return cached
+
+    def assignment(self, holes: list[int], boulders: list[int]) -> int:
+        # Hungarian method over holes (rows) and boulders (columns), O(holes^2 * boulders)
+        if len(holes) > len(boulders):
+            return self.UNREACHABLE * len(holes)
+        cost = [[min(self.hole_distance[h][b], self.UNREACHABLE) for b in boulders] for h in holes]
+        n, m = len(holes), len(boulders)
+        u, v = [0] * (n + 1), [0] * (m + 1)
+        match, way = [0] * (m + 1), [0] * (m + 1)
+        for i in range(1, n + 1):
+            match[0] = i
+            j0 = 0
+            gap = [INF] * (m + 1)
+            used = [False] * (m + 1)
+            while match[j0]:
+                used[j0] = True
+                i0, delta, j1 = match[j0], INF, 0
+                row = cost[i0 - 1]
+                for j in range(1, m + 1):
+                    if used[j]:
+                        continue
+                    reduced = row[j - 1] - u[i0] - v[j]
+                    if reduced < gap[j]:
+                        gap[j], way[j] = reduced, j0
+                    if gap[j] < delta:
+                        delta, j1 = gap[j], j
+                for j in range(m + 1):
+                    if used[j]:
+                        u[match[j]] += delta
+                        v[j] -= delta
+                    else:
+                        gap[j] -= delta
+                j0 = j1
+            while j0:
+                j1 = way[j0]
+                match[j0] = match[j1]
+                j0 = j1
+        return sum(cost[match[j] - 1][j - 1] for j in range(1, m + 1) if match[j])
+
+    def successors(self, area: set[int], boulders: frozenset[int],
+                   holes: frozenset[int]) -> Iterator[tuple[int, int, str, bool]]:
+        for b in boulders:
+            for name, d in self.pushes.items():
+                to = b + d
+                if (b - d) not in area or self.blocked[to] or to in boulders:
+                    continue
+                yield b, to, name, to in holes
+
+    def solve(self) -> list[Push] | None:
+        # pylint: disable=too-many-locals
+        board = self.board
+        self.deadline = perf_counter() + self.budget
+        self.expanded = 0
+
+        zobrist = 0
+        for b in board.boulders:
+            zobrist ^= self.z_boulder[b]
+        for h in board.holes:
+            zobrist ^= self.z_hole[h]
+
+        def key(z: int, player: int, boulders: frozenset[int],
+                holes: frozenset[int]) -> tuple[int, set[int]]:
+            # Player positions are normalized to the top-left reachable cell
+            area = self.reachable(player, boulders, holes)
+            return z ^ self.z_player[min(area)], area
+
+        start, area = key(zobrist, board.player, board.boulders, board.holes)
+        best: dict[int, int] = {start: 0}
+        parent: dict[int, tuple[int, Push] | None] = {start: None}
+        tick = 0
+        frozen = self.freezes(board.boulders, board.holes, board.boulders)
+        heap = [(self.WEIGHT * self.heuristic(board.boulders, board.holes), tick, 0, start, zobrist,
+                 area, board.boulders, board.holes, frozen)]
+
+        while heap:
+            if perf_counter() > self.deadline:
+                return None
+            _, _, g, node, z, area, boulders, holes, frozen = heapq.heappop(heap)
+            if g > best[node]:
+                continue
+            if not holes:
+                return self.path(parent, node)
+            self.expanded += 1
+            if self.expanded % self.CHECKPOINT == 0:
+                # Paused time is not search time
+                self.deadline += tasks.paused()
+
+            for b, to, name, fills in self.successors(area, boulders, holes):
+                nz = z ^ self.z_boulder[b]
+                if fills:
+                    nz ^= self.z_hole[to]
+                    n_boulders = boulders - {b}
+                    n_holes = holes - {to}
+                    # A filled hole is floor to stand on, boulders next to it may thaw
+                    n_frozen = self.freezes(n_boulders, n_holes, n_boulders)
+                else:
+                    nz ^= self.z_boulder[to]
+                    n_boulders = (boulders - {b}) | {to}
+                    n_holes = holes
+                    n_frozen = self.refrozen(frozen, n_boulders, n_holes, to)
+                    if self.deadlocked(n_boulders, n_holes, n_frozen):
+                        continue
+                    # Only a boulder freezing now can close a fence that was open before
+                    if n_frozen != frozen and self.corralled(b, n_boulders, n_holes):
+                        continue
+                child, n_area = key(nz, b, n_boulders, n_holes)
+                if best.get(child, INF) <= g + 1:
+                    continue
+                best[child] = g + 1
+                parent[child] = (node, Push(board.point(b), name, fills))
+                tick += 1
+                f = g + 1 + self.WEIGHT * self.heuristic(n_boulders, n_holes)
+                heapq.heappush(heap, (f, tick, g + 1, child, nz, n_area, n_boulders, n_holes,
+                                      n_frozen))
+        return None
+
+    def path(self, parent: dict[int, tuple[int, Push] | None], node: int) -> list[Push]:
+        pushes = []
+        while (step := parent[node]) is not None:
+            node, push = step
+            pushes.append(push)
+        pushes.reverse()
+        return pushes
@@ -0,0 +1,128 @@
+import json
+import math
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Final, Iterator
+
+STATS_JSON: Final[Path] = Path(__file__).parents[1] / 'tmp/stats.json'
+
+PERCENTILES: Final[tuple[int, ...]] = (50, 95, 99)
+
+# Hot path counters, bumped unconditionally: a dict increment is cheaper than checking a flag
+COUNTERS: Final[Counter[str]] = Counter()
+
+class Histogram:
+    # Log-spaced buckets: 5% relative error, constant memory per bucket
+    BASE: Final[float] = 1.05
+    MIN: Final[float] = 1e-6
+
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        idx = int(math.log(max(value, self.MIN) / self.MIN, self.BASE))
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= rank:
+                return min(self.MIN * self.BASE ** (idx + 1), self.max)
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        result = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+        }
+        for p in PERCENTILES:
+            result[f'p{p}'] = self.percentile(p)
+        return result
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms: dict[str, Histogram] = {}
+        self.sent: float | None = None
+
+    def add(self, name: str, seconds: float) -> None:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def key_sent(self) -> None:
+        # Only the first key of a batch is timestamped, the batch ends on the next frame
+        if self.sent is None:
+            self.sent = perf_counter()
+
+    def frame(self) -> None:
+        if (sent := self.sent) is not None:
+            self.sent = None
+            self.add('key_to_frame', perf_counter() - sent)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            return {name: hist.summary() for name, hist in sorted(self.histograms.items())}
+
+    def dump(self, path: Path = STATS_JSON) -> None:
+        with open(path, 'w', encoding='utf8') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+    def report(self) -> str:
+        lines = [f'{"name":<16}{"count":>8}' + ''.join(f'{f"p{p}":>10}' for p in PERCENTILES)
+                 + f'{"max":>10}']
+        for name, s in self.summary().items():
+            lines.append(f'{name:<16}{int(s["count"]):>8}'
+                         + ''.join(f'{s[f"p{p}"] * 1000:>8.2f}ms' for p in PERCENTILES)
+                         + f'{s["max"] * 1000:>8.2f}ms')
+        return '\n'.join(lines)
+
+STATS: Final[Stats] = Stats()
+
+class Startup:
+    # Where the time from launch to the key loop goes, phase by phase
+    def __init__(self, started: float) -> None:
+        self.started = self.last = started
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, phase: str) -> None:
+        now = perf_counter()
+        self.phases.append((phase, now - self.last))
+        STATS.add(f'startup_{phase}', now - self.last)
+        self.last = now
+
+    def total(self) -> float:
+        return self.last - self.started
+
+    def report(self, budget: float) -> str:
+        lines = [f'{phase:<16}{seconds * 1000:>8.1f}ms' for phase, seconds in self.phases]
+        over = '  OVER BUDGET' if self.total() > budget else ''
+        lines.append(f'{"startup":<16}{self.total() * 1000:>8.1f}ms of {budget * 1000:.0f}ms{over}')
+        return '\n'.join(lines)
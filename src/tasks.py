@@ -0,0 +1,180 @@
+import threading
+
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Final, Iterator
+
+import keyboard
+from keyboard import Keyboard
+
+class Cancelled(Exception):
+    pass
+
+class Task:
+    # Checked cooperatively: the task only stops or pauses at checkpoints
+    POLL: Final[float] = 0.05
+    # Longest a shielded cleanup may hold off an abort
+    SHIELD_TIMEOUT: Final[float] = 10.0
+
+    def __init__(self, name: str, action: Callable[[], object]) -> None:
+        self.name = name
+        self.action = action
+        self.cancelled = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+        self.started = perf_counter()
+        self.done = 0
+        self.total = 0
+        self.note = ''
+        self.shielded = 0
+        self.shield_deadline = 0.0
+        self.thread = threading.Thread(target=self.run, name=f'task-{name}', daemon=True)
+
+    def run(self) -> None:
+        LOCAL.task = self
+        with ACTIVE_LOCK:
+            ACTIVE.add(self)
+        try:
+            self.action()
+        except Cancelled:
+            print(f'Task {self.name} aborted')
+        finally:
+            with ACTIVE_LOCK:
+                ACTIVE.discard(self)
+            LOCAL.task = None
+
+    def alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def checkpoint(self) -> None:
+        if self.shielded and perf_counter() < self.shield_deadline:
+            return
+        while not self.running.wait(self.POLL):
+            if self.cancelled.is_set():
+                break
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def report(self, done: int, total: int, note: str = '') -> None:
+        self.done, self.total, self.note = done, total, note
+
+    def progress(self) -> str:
+        state = 'paused' if not self.running.is_set() else 'running'
+        share = f' ({self.done / self.total:.0%})' if self.total else ''
+        note = f' {self.note}' if self.note else ''
+        return (f'{self.name}: {state}, {self.done}/{self.total}{share}{note},'
+                f' {perf_counter() - self.started:.1f}s')
+
+LOCAL: Final = threading.local()
+# Tasks whose action is running right now, from any thread
+ACTIVE: Final[set[Task]] = set()
+ACTIVE_LOCK: Final = threading.Lock()
+
+def current() -> Task | None:
+    return getattr(LOCAL, 'task', None)
+
+def active() -> bool:
+    return bool(ACTIVE)
+
+def checkpoint() -> None:
+    # Called from press and check, a no-op outside of tasks
+    if task := current():
+        task.checkpoint()
+
+def paused() -> float:
+    # Blocks at a checkpoint, returns how long the task was paused there
+    started = perf_counter()
+    checkpoint()
+    return perf_counter() - started
+
+def wait(condition: threading.Condition, predicate: Callable[[], bool],
+         timeout: float | None = None) -> bool:
+    # Condition.wait_for that aborts and pauses with the task, called with `condition` held.
+    # Time spent paused does not count against the timeout.
+    deadline = None if timeout is None else perf_counter() + timeout
+    while not predicate():
+        if deadline is not None and perf_counter() >= deadline:
+            return False
+        step = Task.POLL if deadline is None else min(Task.POLL, max(deadline - perf_counter(), 0))
+        condition.wait(step)
+        if (task := current()) and (task.cancelled.is_set() or not task.running.is_set()):
+            # Never block at a checkpoint while holding the lock others notify us with
+            condition.release()
+            try:
+                held = paused()
+            finally:
+                condition.acquire()
+            if deadline is not None:
+                deadline += held
+    return True
+
+def report(done: int, total: int, note: str = '') -> None:
+    if task := current():
+        task.report(done, total, note)
+
+@contextmanager
+def shielded(timeout: float = Task.SHIELD_TIMEOUT) -> Iterator[None]:
+    # Cleanup that must finish even after an abort, like restoring game options.
+    # Past the timeout an abort gets through anyway.
+    task = current()
+    if task:
+        if not task.shielded:
+            task.shield_deadline = perf_counter() + timeout
+        task.shielded += 1
+    try:
+        yield
+    finally:
+        if task:
+            task.shielded -= 1
+
+class Executor:
+    # Runs one action at a time off the key loop.
+    # F5 pauses or resumes it, F6 aborts it, F7 prints its progress.
+    def __init__(self, kb: Keyboard) -> None:
+        self.task: Task | None = None
+        self.lock = threading.Lock()
+        # Wake up anything the task may block on outside of checkpoints
+        self.wakeups: list[Callable[[], None]] = []
+
+        kb.bind('F5', keyboard.State(), self.toggle)
+        kb.bind('F6', keyboard.State(), self.abort)
+        kb.bind('F7', keyboard.State(), self.show)
+
+    def busy(self) -> bool:
+        return self.task is not None and self.task.alive()
+
+    def submit(self, name: str, action: Callable[[], object]) -> Task | None:
+        with self.lock:
+            if self.task and self.task.alive():
+                print(f'Busy with {self.task.name}, F6 aborts it')
+                return None
+            self.task = Task(name, action)
+            self.task.thread.start()
+            return self.task
+
+    def toggle(self) -> None:
+        if not (task := self.task) or not task.alive():
+            return
+        if task.running.is_set():
+            task.running.clear()
+        else:
+            task.running.set()
+        print(task.progress())
+
+    def abort(self) -> None:
+        if not (task := self.task) or not task.alive():
+            return
+        task.cancelled.set()
+        task.running.set()
+        for wakeup in self.wakeups:
+            wakeup()
+
+    def show(self) -> None:
+        if task := self.task:
+            print(task.progress() if task.alive() else f'{task.name}: finished')
+        else:
+            print('No task')
+
+    def join(self, timeout: float | None = None) -> None:
+        if task := self.task:
+            task.thread.join(timeout)
@@ -1,21 +1,32 @@
+import codecs
 import copy
+import io
 import logging
+import queue
+import re
+import subprocess
 import sys
 import threading
 
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Final, Iterator, Self, TypeAlias, TextIO
+from typing import Callable, Final, Generator, Iterable, Iterator, Self, TypeAlias
 
 from time import sleep
 
 from point import Point
+from stats import STATS, COUNTERS
 
 Unused: TypeAlias = object  # stable
 
 SCREEN_LOG_FIFO: Final[Path] = Path(__file__).parents[1] / 'tmp/screen_log.fifo'
 SCREEN_LOG_TXT: Final[Path] = Path(__file__).parents[1] / 'tmp/screen_log.txt'
 
+# Columns and rows assumed until the real ones are known
+DEFAULT_GEOMETRY: Final[tuple[int, int]] = (199, 99)
+# `screen -Q info` answers like "(12,5)/(80,24)+1024 +flow UTF-8 0(bash)"
+SCREEN_INFO: Final[re.Pattern[str]] = re.compile(r'\(\d+,\d+\)/\((\d+),(\d+)\)')
+
 def crange(c1: str, c2: str) -> Iterator[str]:
     for c in range(ord(c1), ord(c2)+1):
         yield chr(c)
@@ -26,6 +37,8 @@ def chars(c1: str, c2: str) -> str:
 PARAMETER_BYTES: Final[str] = chars('0', '9') + ':;<=>?'
 INTERMEDIATE_BYTES: Final[str] = '!"#$%&\'()*+,-./'
 FINAL_BYTES: Final[str] = chars('A', 'Z') + chars('a', 'z') + '@[\\]^_`{|}~'
+# CSI finals that move the cursor or erase, they drop a deferred wrap
+CURSOR_FINALS: Final[str] = 'ABCDGHJKSTXdr'
 
 ESC: Final[str] = '\x1b'
 CSI: Final[str] = '\x1b['
@@ -64,6 +77,15 @@ DEC_CHARSET = {
     0x7e: '·',
 }
 
+# Runs of text a charset prints as is, written in one go instead of a char at a time
+RUNS: Final[dict[str, re.Pattern[str]]] = {
+    'USASCII': re.compile('[ -~]+'),
+    'DEC': re.compile('[' + ''.join(map(chr, DEC_CHARSET)) + ']+'),
+}
+DEC_TABLE: Final[dict[int, str]] = dict(DEC_CHARSET)
+# Complete CSI and charset sequences, the same ones parse() collects
+SEQUENCE: Final[re.Pattern[str]] = re.compile('\x1b(?:\\[[^@-~]*[@-~]|\\([\\s\\S])')
+
 @dataclass
 class Attr:
     fg_color: int = 9
@@ -83,6 +105,13 @@ class Attr:
         else:
             return self.bg_color + 90
 
+    def pack(self) -> int:
+        return self.fg_color | self.bg_color << 8 | self.bold << 16 | self.inverse << 17
+
+    @classmethod
+    def unpack(cls, value: int) -> 'Attr':
+        return cls(value & 0xff, value >> 8 & 0xff, bool(value & 1 << 16), bool(value & 1 << 17))
+
     def sgr(self) -> str:
         return ('0;' + ('7;' if self.inverse else '')
                      + ('1;' if self.bold else '')
@@ -104,22 +133,93 @@ class Glyph:
     def __str__(self) -> str:
         return CSI + self.attr.sgr() + 'm' + self.char + CSI + '0m'
 
+# Change kinds delivered to subscribers, in this order within a frame
+CLEAR: Final[str] = 'clear'
+ROW: Final[str] = 'row'
+CURSOR: Final[str] = 'cursor'
+FRAME: Final[str] = 'frame'
+
+@dataclass(frozen=True)
+class Change:
+    kind: str
+    row: int = 0
+    text: str = ''
+    cursor: Point | None = None
+
+class Subscription:
+    def __init__(self, kinds: frozenset[str], rows: frozenset[int] | None) -> None:
+        self.kinds = kinds
+        self.rows = rows
+        self.queue: queue.SimpleQueue[Change] = queue.SimpleQueue()
+
+    def wants(self, change: Change) -> bool:
+        if change.kind not in self.kinds:
+            return False
+        return change.kind != ROW or self.rows is None or change.row in self.rows
+
+    def get(self, timeout: float | None = None) -> Change | None:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self) -> list[Change]:
+        changes = []
+        while not self.queue.empty():
+            changes.append(self.queue.get())
+        return changes
+
 class Term:
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, logger: logging.Logger = logging.getLogger(), fifo: bool = True) -> None:
-        self.redraw: threading.Condition
+    CHUNK: Final[int] = 4096
+
+    def __init__(self, logger: logging.Logger = logging.getLogger(), fifo: bool = True,
+                 geometry: tuple[int, int] | None = None) -> None:
         self.idx: int
-        self.fp: TextIO
+        self.fp: io.BufferedReader
+        self.decoder = codecs.getincrementaldecoder('utf8')()
 
-        self.width = 200
-        self.height = 100
-        self.glyphs: list[list[Glyph | None]] = [
-            [None for x in range(self.width)] for y in range(self.height)
-        ]
+        self.redraw = threading.Condition()
+        self.listeners: list[Callable[[], None]] = []
+        self.subscriptions: list[Subscription] = []
+        self.subscriptions_lock = threading.Lock()
+        # Rows touched since the last frame, compared against what subscribers last saw
+        self.dirty: set[int] = set()
+        self.texts: dict[int, str] = {}
+        self.attrs: dict[int, list[int]] = {}
+        self.cleared = False
+        self.clears = 0
+        self.published_cursor = Point(0, 0)
+        self.parser: Generator[None, str, None] | None = None
+        # The parser is between sequences, plain text can bypass it
+        self.ground = True
+
+        self.fifo = fifo
+        self.stop = False
+        self.logger = logger
+        self.reading = False
+        # Columns and rows are 1-based, index 0 stays unused
+        columns, rows = geometry or DEFAULT_GEOMETRY
+        self.width, self.height = columns + 1, rows + 1
+        # The grid itself only ever grows: other threads index it while the parser resizes,
+        # so width and height only bound what the parser writes
+        self.capacity = (max(self.width, DEFAULT_GEOMETRY[0] + 1),
+                         max(self.height, DEFAULT_GEOMETRY[1] + 1))
+        # Without a given geometry the grid is fitted to the game's terminal once output arrives
+        self.fitted = geometry is not None or not fifo
+        self.pending_geometry: tuple[int, int] | None = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.glyphs: list[list[Glyph | None]] = [self.blank_row() for y in range(self.capacity[1])]
         self.charset = 'USASCII'
         self.show_cursor = True
         self.wrap = True
+        # xenl: a glyph in the last column leaves the cursor there, the next one wraps first
+        self.pending_wrap = False
         self.attr = Attr()
+        # Copy of attr shared by the glyphs of runs, glyph attributes are never changed in place
+        self.run_attr = Attr()
 
         self.top = 1
         self.bottom = self.height - 1
@@ -128,18 +228,55 @@ class Term:
         self.maxy = 0
 
         self.log = ''
-        self.fifo = fifo
-        self.stop = False
-        self.logger = logger
-        self.reading = False
+        self.dirty = set()
+        self.cleared = True
+        self.clears += 1
+
+    def blank_row(self) -> list[Glyph | None]:
+        return [None] * self.capacity[0]
+
+    def resize(self, columns: int, rows: int) -> None:
+        width, height = columns + 1, rows + 1
+        span, depth = self.capacity
+        # Rows grow in place and new ones are appended, a reader never sees a shorter grid
+        if width > span:
+            for row in self.glyphs:
+                row.extend([None] * (width - span))
+        self.capacity = span, depth = max(span, width), max(depth, height)
+        while len(self.glyphs) < depth:
+            self.glyphs.append(self.blank_row())
+        # What falls outside the new edges is blanked, not dropped
+        for y, row in enumerate(self.glyphs):
+            if y >= height:
+                row[:] = self.blank_row()
+            elif width < span:
+                row[width:] = [None] * (span - width)
+        self.width, self.height = width, height
+        self.top, self.bottom = 1, height - 1
+        self.cursor = Point(min(self.cursor.x, width - 1), min(self.cursor.y, height - 1))
+        self.pending_wrap = False
+        self.maxy = min(self.maxy, height - 1)
+        self.dirty.update(range(depth))
+
+    def fit(self) -> None:
+        # `screen -Q` may take up to its timeout, the parser keeps going meanwhile
+        self.fitted = True
+        threading.Thread(target=self.query_geometry, name='term-fit', daemon=True).start()
+
+    def query_geometry(self) -> None:
+        self.pending_geometry = screen_geometry()
+
+    def apply_geometry(self) -> None:
+        # Parser thread only, between two chunks of output
+        if geometry := self.pending_geometry:
+            self.pending_geometry = None
+            self.resize(*geometry)
+            self.logger.info('Geometry: %dx%d', *geometry)
 
     def __enter__(self) -> Self:
-        self.redraw = threading.Condition()
         self.idx = 0
-        if self.fifo:
-            self.fp = open(SCREEN_LOG_FIFO, 'r', encoding='utf8', newline='')
-        else:
-            self.fp = open(SCREEN_LOG_TXT, 'r', encoding='utf8', newline='')
+        self.decoder.reset()
+        self.fp = open(SCREEN_LOG_FIFO if self.fifo else SCREEN_LOG_TXT, 'rb')
         return self
 
     def __exit__(self, *exc_info: Unused) -> None:
@@ -150,6 +287,7 @@ class Term:
 
     def __setitem__(self, at: Point, value: Glyph) -> None:
         self.glyphs[at.y][at.x] = value
+        self.dirty.add(at.y)
 
     def at(self, x: int, y: int) -> None | Glyph:
         return self[Point(x, y)]
@@ -157,6 +295,9 @@ class Term:
     def line(self, y: int) -> str:
         return ''.join(glyph.char if glyph else ' ' for glyph in self.glyphs[y])
 
+    def row_attrs(self, y: int) -> list[int]:
+        return [glyph.attr.pack() if glyph else 0 for glyph in self.glyphs[y]]
+
     def lines(self) -> Iterator[str]:
         for y in range(1, self.maxy):
             yield self.line(y)
@@ -166,14 +307,22 @@ class Term:
             self.logger.info("String: '%s'", self.log)
             self.log = ''
 
+    def snapshot(self) -> list[list[Glyph | None]]:
+        # A copy of the grid for code that walks it outside the parser thread
+        return [row[:] for row in self.glyphs]
+
     def print(self) -> None:
-        if self.show_cursor:
-            cur = self[self.cursor]
-            if cur:
-                cur.attr.inverse = True
+        # Printed from a copy, the cursor mark must not end up in the grid
+        glyphs = self.snapshot()[:self.maxy + 1]
+        if self.show_cursor and self.cursor.y < len(glyphs):
+            # Glyphs of a run share their attributes, mark a copy
+            if cur := glyphs[self.cursor.y][self.cursor.x]:
+                attr = copy.copy(cur.attr)
+                attr.inverse = True
+                glyphs[self.cursor.y][self.cursor.x] = Glyph(cur.char, attr)
 
         print(f'{ESC}[1;1H', end='') # Move cursor to the beginning
-        for y, row in enumerate(self.glyphs):
+        for y, row in enumerate(glyphs):
             if y == 0:
                 continue
             if y > self.maxy:
@@ -188,32 +337,88 @@ class Term:
                     print(' ', end='')
             print()
 
+    def subscribe(self, kinds: Iterable[str], rows: Iterable[int] | None = None) -> Subscription:
+        subscription = Subscription(frozenset(kinds), None if rows is None else frozenset(rows))
+        with self.subscriptions_lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.subscriptions_lock:
+            self.subscriptions.remove(subscription)
+
+    def publish(self) -> None:
+        with self.subscriptions_lock:
+            subscriptions = list(self.subscriptions)
+        if not subscriptions:
+            # Nobody to compare for, start over once someone subscribes
+            self.dirty.clear()
+            self.texts.clear()
+            self.attrs.clear()
+            self.cleared = False
+            return
+
+        changes = []
+        if self.cleared:
+            self.cleared = False
+            self.texts.clear()
+            self.attrs.clear()
+            changes.append(Change(CLEAR))
+        for y in sorted(self.dirty):
+            # Attributes count too: a recoloured monster or a highlighted menu line keeps its text
+            text, attrs = self.line(y), self.row_attrs(y)
+            if text != self.texts.get(y) or attrs != self.attrs.get(y):
+                self.texts[y] = text
+                self.attrs[y] = attrs
+                changes.append(Change(ROW, y, text))
+        self.dirty.clear()
+        if self.cursor != self.published_cursor:
+            self.published_cursor = copy.copy(self.cursor)
+            changes.append(Change(CURSOR, cursor=self.published_cursor))
+        changes.append(Change(FRAME, cursor=self.published_cursor))
+
+        COUNTERS['changes'] += len(changes)
+        for subscription in subscriptions:
+            for change in changes:
+                if subscription.wants(change):
+                    subscription.queue.put(change)
+
+    def frame(self) -> None:
+        STATS.frame()
+        with self.redraw:
+            self.redraw.notify_all()
+        self.publish()
+        for listener in self.listeners:
+            listener()
+
     def scroll(self, value: int = 1) -> None:
+        self.dirty.update(range(self.top, self.bottom + 1))
         if value > 0:
             for i in range(self.top, self.bottom, 1):
                 self.glyphs[i] = self.glyphs[i + value]
             for i in range(self.bottom - value + 1, self.bottom + 1):
-                self.glyphs[i] = [None for x in range(self.width)]
+                self.glyphs[i] = self.blank_row()
         else:
             for i in range(self.bottom, self.top, -1):
                 self.glyphs[i] = self.glyphs[i + value]
             for i in range(self.top, self.top - value):
-                self.glyphs[i] = [None for x in range(self.width)]
+                self.glyphs[i] = self.blank_row()
 
     def cursor_dx(self, dx: int) -> None:
-        if dx > 0:
-            for _ in range(dx):
-                self.cursor.x += 1
-                if self.cursor.x >= self.width:
-                    if self.wrap:
-                        self.cursor_dy(1)
-                        self.cursor.x = 1
-                    else:
-                        self.cursor.x = self.width - 1
-        else:
-            for _ in range(-dx):
-                self.cursor.x -= 1
-                self.cursor.x = max(self.cursor.x, 1)
+        # Cursor movement stops at the margins, only printing wraps
+        self.cursor.x = max(1, min(self.cursor.x + dx, self.width - 1))
+
+    def advance(self) -> None:
+        if self.cursor.x < self.width - 1:
+            self.cursor.x += 1
+        elif self.wrap:
+            self.pending_wrap = True
+
+    def do_wrap(self) -> None:
+        if self.pending_wrap:
+            self.pending_wrap = False
+            self.cursor_dy(1)
+            self.cursor.x = 1
 
     def cursor_dy(self, dy: int) -> None:
         if dy > 0:
@@ -230,13 +435,17 @@ class Term:
                     self.cursor.y = self.top
 
     def handle_char(self, char: str) -> None:
+        COUNTERS['cells_parsed'] += 1
         if self.charset == 'USASCII':
             if ord(char) in range(ord(' '), ord('~') + 1):
+                self.do_wrap()
                 self[self.cursor] = Glyph(char, copy.copy(self.attr))
+                COUNTERS['glyphs'] += 1
                 self.log += char
             else:
                 self.flush()
                 self.logger.info('ORD: %d %s', ord(char), char)
+                self.pending_wrap = False
                 match ord(char):
                     case 10: # Line Feed
                         self.cursor_dy(1)
@@ -249,19 +458,60 @@ class Term:
                         self.logger.error('Unknown ASCII: %d %s', ord(char), char)
                         # Read the char anyway
                         self[self.cursor] = Glyph(char, copy.copy(self.attr))
-                        self.cursor_dx(1)
+                        self.advance()
                 return
         if self.charset == 'DEC':
             self.flush()
+            self.do_wrap()
             self[self.cursor] = Glyph(
                 DEC_CHARSET[ord(char)], copy.copy(self.attr)
             )
-        self.cursor_dx(1)
+            COUNTERS['glyphs'] += 1
+        self.advance()
+        self.maxy = max(self.maxy, self.cursor.y)
+
+    def write(self, text: str) -> None:
+        # Same outcome as handle_char for every char of the run, cursor arithmetic once per row
+        COUNTERS['cells_parsed'] += len(text)
+        COUNTERS['glyphs'] += len(text)
+        COUNTERS['runs'] += 1
+        if self.charset == 'DEC':
+            self.flush()
+            text = text.translate(DEC_TABLE)
+        else:
+            self.log += text
+        if self.run_attr != self.attr:
+            self.run_attr = copy.copy(self.attr)
+        attr = self.run_attr
+
+        while text:
+            self.do_wrap()
+            x, y = self.cursor.x, self.cursor.y
+            if not self.wrap:
+                # The last column takes whatever does not fit
+                n = min(len(text), self.width - 1 - x)
+                self.glyphs[y][x:x + n] = [Glyph(c, attr) for c in text[:n]]
+                if n < len(text):
+                    self.glyphs[y][self.width - 1] = Glyph(text[-1], attr)
+                self.cursor.x = min(x + len(text), self.width - 1)
+                self.dirty.add(y)
+                break
+
+            n = min(len(text), self.width - x)
+            self.glyphs[y][x:x + n] = [Glyph(c, attr) for c in text[:n]]
+            self.dirty.add(y)
+            text = text[n:]
+            if x + n < self.width:
+                self.cursor.x = x + n
+            else:
+                self.cursor.x = self.width - 1
+                self.pending_wrap = True
         self.maxy = max(self.maxy, self.cursor.y)
 
     def clearFrom(self) -> None:
         x = self.cursor.x
         y = self.cursor.y
+        self.dirty.update(range(y, self.maxy + 1))
         while True:
             self.glyphs[y][x] = Glyph()
             x += 1
@@ -274,6 +524,7 @@ class Term:
     def clearTo(self) -> None:
         x = 1
         y = 1
+        self.dirty.update(range(1, self.cursor.y + 1))
         while True:
             self.glyphs[y][x] = Glyph()
             x += 1
@@ -285,6 +536,8 @@ class Term:
 
     # https://xtermjs.org/docs/api/vtfeatures/#csi
     def handle_csi(self, csi: str) -> None:
+        if csi[-1] in CURSOR_FINALS:
+            self.pending_wrap = False
         match csi[-1]:
             case 'J':
                 match self.getPs(csi, 0):
@@ -293,8 +546,7 @@ class Term:
                     case 1:
                         self.clearTo()
                     case 2:
-                        # pylint: disable=unnecessary-dunder-call
-                        self.__init__(self.logger, self.fifo) # type: ignore
+                        self.reset()
                     case _:
                         self.logger.error('Unknown CSI: %s', self.ansitostr(csi))
             case 'H':
@@ -314,6 +566,7 @@ class Term:
             case 'D':
                 self.cursor_dx(-self.getPs(csi, 1))
             case 'K':
+                self.dirty.add(self.cursor.y)
                 match self.getPs(csi, 0):
                     case 0:
                         for x in range(self.cursor.x, self.width):
@@ -329,6 +582,7 @@ class Term:
             case 'S':
                 self.scroll(self.getPs(csi, 1))
             case 'X':
+                self.dirty.add(self.cursor.y)
                 tx = self.cursor.x
                 for _ in range(self.getPs(csi, 1)):
                     self.glyphs[self.cursor.y][tx] = Glyph()
@@ -370,10 +624,10 @@ class Term:
                     case '?25':
                         self.show_cursor = csi[-1] == 'h'
                         if csi[-1] == 'h':
-                            with self.redraw:
-                                self.redraw.notify_all()
+                            self.frame()
                     case '?7':
                         self.wrap = csi[-1] == 'h'
+                        self.pending_wrap = False
                     case s if s in ['?12', '?1', '?1049', '4', '?1034', '?2004']:
                         self.logger.warning('Unsupported Terminal attribute: %s',
                                         self.ansitostr(csi))
@@ -387,23 +641,26 @@ class Term:
                 self.logger.error('Unknown CSI: %s', self.ansitostr(csi))
 
     def read(self) -> str:
+        # Whatever is available, so runs of text reach the parser whole
         if self.fifo:
             self.reading = False
-            while not (c := self.fp.read(1)):
+            while not (data := self.fp.read1(self.CHUNK)):
                 pass
             self.reading = True
-            return c
+            return self.decoder.decode(data)
         else:
             self.reading = True
-            if not (c := self.fp.read(1)):
+            if not (data := self.fp.read1(self.CHUNK)):
                 self.stop = True
                 return ESC
             self.reading = False
-            return c
+            return self.decoder.decode(data)
 
     def do_yield(self) -> None:
+        COUNTERS['yields'] += 1
         sleep(0.001)
         while self.reading:
+            COUNTERS['yield_spins'] += 1
             sleep(0.001)
 
     def start(self) -> None:
@@ -413,49 +670,89 @@ class Term:
     def run(self) -> None:
         while not self.stop:
             s = self.read()
+            if not self.fitted:
+                self.fit()
+            self.apply_geometry()
             if len(sys.argv) > 1 and self.idx > int(sys.argv[1]):
                 self.print()
                 sys.exit()
+            self.feed(s)
+
+    def feed(self, data: str) -> None:
+        if not self.parser:
+            self.parser = self.parse()
+            next(self.parser)
+        parser = self.parser
+        i, end = 0, len(data)
+        while i < end:
+            # Whole runs and sequences skip the generator, split ones still go through it
+            if not self.ground:
+                parser.send(data[i])
+                i += 1
+            elif run := RUNS[self.charset].match(data, i):
+                self.write(run.group())
+                i = run.end()
+            elif sequence := SEQUENCE.match(data, i):
+                self.handle_escape(sequence.group())
+                i = sequence.end()
+            else:
+                parser.send(data[i])
+                i += 1
+
+    def parse(self) -> Generator[None, str, None]:
+        # Receives the output one character at a time, so it can be fed from any source
+        while True:
+            self.ground = True
+            s = yield
+            self.ground = False
             if s != ESC:
                 self.handle_char(s)
-            else:
-                self.flush()
-                s += self.read()
+                continue
+
+            s += yield
+            match s[-1]:
+                case '[': # CSI
+                    s += yield
+                    while s[-1] not in FINAL_BYTES:
+                        s += yield
+                case ']': # OSC
+                    s += yield
+                    while ord(s[-1]) != 7: # BEL
+                        s += yield
+                case '(': # Charset
+                    s += yield
+            self.handle_escape(s)
+
+    def handle_escape(self, s: str) -> None:
+        self.flush()
+        match s[1]:
+            case '[': # CSI
+                self.handle_csi(s)
+            case ']': # OSC
+                pass
+            case '(': # Charset
                 match s[-1]:
-                    case '[': # CSI
-                        s += self.read()
-                        while s[-1] not in FINAL_BYTES:
-                            s += self.read()
-
-                        self.handle_csi(s)
-
-                    case ']': # OSC
-                        s += self.read()
-                        while ord(s[-1]) != 7: # BEL
-                            s += self.read()
-
-                    case '(': # Charset
-                        s += self.read()
-                        match s[-1]:
-                            case '0':
-                                self.charset = 'DEC'
-                            case 'B':
-                                self.charset = 'USASCII'
-                            case _:
-                                self.logger.error('Charset: %s %s', s[-1],
-                                                  self.ansitostr(s))
-                    case 'M': # Move up
-                        self.cursor_dy(-1)
-                    case '7': # Save cursor
-                        self.save_cursor = self.cursor
-                    case '8': # Restore cursor
-                        self.cursor = self.save_cursor or self.cursor
-                    case '=' | '>' | ']':
-                        self.logger.warning('Unsupported ANSI: %s', self.ansitostr(s))
+                    case '0':
+                        self.charset = 'DEC'
+                    case 'B':
+                        self.charset = 'USASCII'
                     case _:
-                        self.logger.error('Unknown ANSI: %s', self.ansitostr(s))
+                        self.logger.error('Charset: %s %s', s[-1],
+                                          self.ansitostr(s))
+            case 'M': # Move up
+                self.pending_wrap = False
+                self.cursor_dy(-1)
+            case '7': # Save cursor
+                self.save_cursor = self.cursor
+            case '8': # Restore cursor
+                self.pending_wrap = False
+                self.cursor = self.save_cursor or self.cursor
+            case '=' | '>':
+                self.logger.warning('Unsupported ANSI: %s', self.ansitostr(s))
+            case _:
+                self.logger.error('Unknown ANSI: %s', self.ansitostr(s))
 
-                self.logger.info('ANSI: %s', self.ansitostr(s))
+        self.logger.info('ANSI: %s', self.ansitostr(s))
 
     def ansitostr(self, csi: str) -> str:
         return csi.replace(ESC, "ESC")
@@ -475,6 +772,16 @@ class Term:
     def getPs(self, csi: str, default: int) -> int:
         return next(self.getPm(csi, [default]))
 
+def screen_geometry(session: str = 'nethack') -> tuple[int, int] | None:
+    try:
+        info = subprocess.run(['screen', '-S', session, '-Q', 'info'],
+                              capture_output=True, text=True, timeout=1.0, check=False).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if match := SCREEN_INFO.search(info):
+        return int(match.group(1)), int(match.group(2))
+    return None
+
 def test() -> None:
     logging.basicConfig(
         filename='log.txt',
@@ -0,0 +1,89 @@
+# mypy: disable-error-code="misc"
+
+from typing import Final
+
+from Xlib import X, XK, display
+from Xlib.ext import record
+from Xlib.protocol import rq
+
+from keyboard import Backend, Emit, State
+
+
+def keysym_names() -> dict[int, str]:
+    names: dict[int, str] = {}
+    for name in dir(XK):
+        if name[:3] == 'XK_':
+            names.setdefault(getattr(XK, name), name[3:])
+    return names
+
+KEYSYMS: Final[dict[int, str]] = keysym_names()
+
+class XRecordBackend(Backend):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.local_dpy = display.Display()
+        self.record_dpy = display.Display()
+        self.event_field = rq.EventField('')
+        self.emit: Emit | None = None
+
+        # Check if the extension is present
+        if not self.record_dpy.has_extension('RECORD'):
+            raise ValueError('RECORD extension not found')
+
+        # Create a recording context; we only want key and mouse events
+        self.context = self.record_dpy.record_create_context(
+                0,
+                [record.AllClients],
+                [{
+                        'core_requests': (0, 0),
+                        'core_replies': (0, 0),
+                        'ext_requests': (0, 0, 0, 0),
+                        'ext_replies': (0, 0, 0, 0),
+                        'delivered_events': (0, 0),
+                        'device_events': (X.KeyPress, X.KeyPress),
+                        'errors': (0, 0),
+                        'client_started': False,
+                        'client_died': False,
+                }])
+
+    def lookup_keysym(self, keysym: int) -> str:
+        return KEYSYMS.get(keysym) or f'[{keysym}]'
+
+    def record_callback(self, reply: rq.DictWrapper) -> None:
+        if reply.category != record.FromServer:
+            return
+        if reply.client_swapped:
+            # received swapped protocol data, cowardly ignored
+            return
+        if not reply.data or reply.data[0] < 2:
+            # not an event
+            return
+
+        data = reply.data
+        while len(data):
+            event, data = self.event_field.parse_binary_value(
+                data, self.record_dpy.display, None, None)
+
+            if event.type in [X.KeyPress, X.KeyRelease]:
+                keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
+                if not keysym or not self.emit:
+                    continue
+
+                self.emit(self.lookup_keysym(keysym), State(event.state))
+
+    def run(self, emit: Emit) -> None:
+        self.emit = emit
+
+        # Enable the context; this only returns after a call to
+        # record_disable_context, while calling the callback function in the
+        # meantime
+        self.record_dpy.record_enable_context(self.context, self.record_callback)
+
+        # Finally free the context
+        self.record_dpy.record_free_context(self.context)
+
+    def stop(self) -> None:
+        super().stop()
+        self.local_dpy.record_disable_context(self.context)
+        self.local_dpy.flush()